@@ -1,133 +1,270 @@
-from classes import Dataset
+from classes import Dataset, DeltaInstance
+from window_index import UserEvents, WindowIndex
 from logger import logger
+from metrics import metrics
 from datetime import datetime, timezone, timedelta
+from time import perf_counter
+from typing import Callable, Iterable
+import os
+from leaderboard import Leaderboard
+from itertools import count
+from bisect import bisect_left, bisect_right
+from threading import RLock
 from utils import *
 
+__versions = count(1)
+
+# Every built or changed analytics gets a new version, so results cached for an older one are not reused
+def next_analytics_version() -> int:
+    return next(__versions)
+
+# Everything the rankings panel and the numeric statistics show about one user. The current
+# streak depends on the time of the query, so it is refreshed from the streak deadline
+class UserSummary:
+    def __init__(self, user: str, length: int, best_rank: int, events_count: int, average_interval: timedelta, best_streak: tuple[datetime, datetime, int], last_streak_count: int, streak_deadline: int):
+        self.user = user
+        self.length = length
+        self.best_rank = best_rank
+        self.events_count = events_count
+        self.average_interval = average_interval
+        self.best_streak = best_streak
+        self.last_streak_count = last_streak_count
+        self.streak_deadline = streak_deadline
+        self.current_streak = 0
+
+    def refresh(self, now: float):
+        self.current_streak = self.last_streak_count if now <= self.streak_deadline else 0
+
+# Entries of a time ordered list between start and end, a missing bound doesn't limit that side.
+# With neighbours, the closest entries outside of the window are included too
+def time_window(entries: list[tuple], start: datetime = None, end: datetime = None, neighbours: bool = False) -> list[tuple]:
+    first = 0 if start is None else bisect_left(entries, start, key=lambda entry: entry[0])
+    last = len(entries) if end is None else bisect_right(entries, end, key=lambda entry: entry[0])
+    if neighbours:
+        first = max(first - 1, 0)
+        last = min(last + 1, len(entries))
+    return entries[first:last]
+
 class Analytics:
+    # Backends, that read histories and deltas of users from elsewhere, don't keep them in memory
+    keeps_user_histories = True
 
-    def __list_users(self, dataset: Dataset):
-        logger.info(f"[Analytics] Starting to list all users")
-        self.users = set()
-        for delta in dataset.deltas:
-            user = delta.user
-            self.users.add(user)
-        logger.info(f"[Analytics] Done! Found a total of {len(self.users)} users")
+    def __count_user(self, delta: DeltaInstance, length: int):
+        self.users.add(delta.user)
 
-    def __check_deltas(self, dataset: Dataset):
-        logger.info(f"[Analytics] Starting to check deltas for inconsistencies")
-        user_lengths = {}
-        for delta in dataset.deltas:
-            user = delta.user
-            cur_length = apply_delta(user_lengths.get(user, 0), delta)
-            user_lengths[user] = cur_length
-            if delta.new_length is not None and cur_length != delta.new_length:
-                logger.warning(f"Warning! Calculated and provided lengths don't match: user = {user} time = {delta.timestamp} expected = {cur_length} actual = {delta.new_length}")
-        logger.info(f"[Analytics] Finished checkin deltas for inconsistencies")
-
-    def __calculate_user_length_histories(self, dataset: Dataset):
-        logger.info(f"[Analytics] Starting to calculate user length histories")
+    def __check_delta(self, delta: DeltaInstance, length: int):
+        if delta.new_length is not None and length != delta.new_length:
+            logger.warning(f"Warning! Calculated and provided lengths don't match: user = {delta.user} time = {delta.timestamp} expected = {length} actual = {delta.new_length}")
+
+    def __record_length(self, delta: DeltaInstance, length: int):
+        history = self.user_length_histories.get(delta.user)
+        if history is None:
+            history = []
+            self.user_length_histories[delta.user] = history
+        history.append((delta.timestamp, length))
+
+    def __record_delta(self, delta: DeltaInstance, length: int):
+        deltas = self.user_deltas.get(delta.user)
+        if deltas is None:
+            deltas = []
+            self.user_deltas[delta.user] = deltas
+        deltas.append((delta.timestamp, delta.delta))
+
+    def __update_best_players(self, delta: DeltaInstance, length: int):
+        leaderboard = self.__leaderboard
+        leaderboard.update(delta.user, length)
+        best = leaderboard.leader()
+        if best != self.__cur_best:
+            cur_time = delta.timestamp
+            if self.__cur_best is not None:
+                self.best_players_history.append((self.__cur_best, self.__cur_start, cur_time))
+            self.__cur_best = best
+            self.__cur_start = cur_time
+
+    def __finish_best_players(self):
+        if self.__cur_best is not None:
+            self.best_players_history.append((self.__cur_best, self.__cur_start, datetime.now(timezone.utc)))
+
+    def __update_streak(self, delta: DeltaInstance, length: int):
+        user = delta.user
+        date = delta.timestamp
+        calendar = self.__calendar
+        day = calendar.day_end(date.timestamp())
+        current_streak = self.__current_streak
+        if user not in current_streak:
+            current_streak[user] = (date, date, 1)
+            self.__streak_days[user] = day
+            return
+        start_date, prev_date, cur_streak_count = current_streak[user]
+        prev_day = self.__streak_days[user]
+        if prev_day == day:
+            logger.warning(f"[Analytics] Warning while calculating streaks! Two events in the same day! user = {user} prev_date = {prev_date} date = {date}")
+            cur_streak_count = 0
+        elif calendar.next_day_end(prev_day) == day:
+            cur_streak_count += 1
+        else:
+            self.__close_streak(user)
+            cur_streak_count = 1
+            start_date = date
+        current_streak[user] = (start_date, date, cur_streak_count)
+        self.__streak_days[user] = day
+
+    def __close_streak(self, user: str):
+        streak = self.__current_streak.get(user)
+        if streak is None:
+            return
+        if user not in self.streaks:
+            self.streaks[user] = []
+        self.streaks[user].append(streak)
+
+    def __finish_streaks(self):
+        for user in self.__current_streak.keys():
+            self.__close_streak(user)
+
+    def __stages(self) -> list[tuple[str, Callable[[DeltaInstance, int], None], Callable[[], None]]]:
+        stages = [
+            ("users", self.__count_user, None),
+            ("checks", self.__check_delta, None),
+            ("length_histories", self.__record_length, None),
+            ("user_deltas", self.__record_delta, None),
+            ("best_players", self.__update_best_players, self.__finish_best_players),
+            ("streaks", self.__update_streak, self.__finish_streaks),
+        ]
+        if not self.keeps_user_histories:
+            stages = [stage for stage in stages if stage[0] not in ("length_histories", "user_deltas")]
+        return stages
+
+    def __reset(self):
+        self.users: set[str] = set()
         self.user_length_histories: dict[str,list[tuple[datetime, int]]] = {}
-        user_lengths = {}
-        for delta in dataset.deltas:
-            user = delta.user
-            cur_length = apply_delta(user_lengths.get(user, 0), delta)
-            user_lengths[user] = cur_length
-            if user not in self.user_length_histories:
-                self.user_length_histories[user] = []
-            self.user_length_histories[user].append((delta.timestamp,cur_length))
-        logger.info(f"[Analytics] User length histories are done!")
-
-    def __calculate_user_deltas(self, dataset: Dataset):
-        logger.info(f"[Analytics] Starting to calculate user deltas")
         self.user_deltas: dict[str, list[tuple[datetime, int]]] = {}
-        for delta in dataset.deltas:
-            user = delta.user
-            if user not in self.user_deltas:
-                self.user_deltas[user] = []
-            self.user_deltas[user].append((delta.timestamp, delta.delta))
-        logger.info(f"[Analytics] User deltas are done!")
-
-    def __calculate_best_players_history(self, dataset: Dataset):
-        logger.info(f"[Analytics] Starting to calculate best players history")
         self.best_players_history: list[tuple[str, datetime, datetime]] = []
-        self.best_rank: dict[str, int] = {}
-        user_lengths = {}
-        cur_best: str = None
-        cur_start: datetime = None
-        for delta in dataset.deltas:
-            user = delta.user
-            cur_length = apply_delta(user_lengths.get(user, 0), delta)
-            user_lengths[user] = cur_length
-
-            # update best
-            best = max(user_lengths, key=user_lengths.get)
-            if best != cur_best:
-                cur_time = delta.timestamp
-                if cur_best is not None:
-                    self.best_players_history.append((cur_best, cur_start, cur_time))
-                cur_best = best
-                cur_start = cur_time
-
-            # update best ranks
-            for i, (user, length) in enumerate(
-                sorted(user_lengths.items(), key=lambda kv: kv[1], reverse=True)
-            ):
-                rank = i+1
-                cur_rank = self.best_rank.get(user)
-                if cur_rank is None or rank < cur_rank:
-                    self.best_rank[user] = rank
-                
-        if cur_best is not None:
-            self.best_players_history.append((cur_best, cur_start, datetime.now(timezone.utc)))
-        logger.info(f"[Analytics] Best players history is done!")
-
-    def __calculate_streaks(self, dataset: Dataset):
-        logger.info(f"[Analytics] Starting to calculate streaks")
+        self.__leaderboard = Leaderboard()
+        self.best_rank: dict[str, int] = self.__leaderboard.best_rank
         self.streaks: dict[str, list[tuple[datetime, datetime, int]]] = {}
-        current_streak: dict[str, tuple[datetime, datetime, int]] = {}
-        def add_streak(user: str, streak: tuple[datetime, datetime, int]):
-            if user not in self.streaks:
-                self.streaks[user] = []
-            self.streaks[user].append(streak)
-        def close_streak(user: str):
-            if user not in current_streak:
-                return
-            add_streak(user, current_streak.get(user))
-        for delta in dataset.deltas:
+        self.stage_timings: dict[str, float] = {}
+        self.__user_lengths: dict[str, int] = {}
+        self.__cur_best: str = None
+        self.__cur_start: datetime = None
+        self.__current_streak: dict[str, tuple[datetime, datetime, int]] = {}
+        self.__streak_days: dict[str, int] = {}
+        self.__calendar = get_calendar()
+
+    # All stages share one traversal of the deltas and the running lengths computed in it.
+    # Running state is kept afterwards, so a later traversal can continue with new deltas
+    def __traverse(self, deltas: Iterable[DeltaInstance]):
+        stages = self.__stages()
+        profile = os.getenv("ANALYTICS_PROFILE") == "TRUE"
+        timings = {name: 0.0 for name, _, _ in stages} if profile else {}
+        user_lengths = self.__user_lengths
+        start_time = perf_counter()
+        for delta in deltas:
             user = delta.user
-            date = delta.timestamp
-            cur_streak_count = 0
-            if user not in current_streak:
-                current_streak[user] = (date, date, 1)
-                cur_streak_count = 1
+            length = apply_delta(user_lengths.get(user, 0), delta)
+            user_lengths[user] = length
+            if profile:
+                for name, update, _ in stages:
+                    stage_start = perf_counter()
+                    update(delta, length)
+                    timings[name] += perf_counter() - stage_start
             else:
-                streak = current_streak.get(user)
-                prev_date = streak[1]
-                start_date = streak[0]
-                if same_pesun_day(prev_date, date):
-                    logger.warning(f"[Analytics] Warning while calculating streaks! Two events in the same day! user = {user} prev_date = {prev_date} date = {date}")
-                elif consecutive_pesun_days(prev_date, delta.timestamp):
-                    cur_streak_count = streak[2]+1
-                else:
-                    close_streak(user)
-                    cur_streak_count = 1
-                    start_date = date
-                current_streak[user] = (start_date, date, cur_streak_count)
-        for user in current_streak.keys():
-            close_streak(user)
-        logger.info(f"[Analytics] Streaks are done!")
+                for _, update, _ in stages:
+                    update(delta, length)
+        traversal_time = perf_counter() - start_time
+        for name, _, finish in stages:
+            if finish is not None:
+                stage_start = perf_counter()
+                finish()
+                timings[name] = timings.get(name, 0.0) + perf_counter() - stage_start
+        self.stage_timings = timings
+        self.stage_timings["traversal"] = traversal_time
+        self.__report_timings(profile)
 
-    def __init__(self, dataset: Dataset):
+    # Takes back what the finish steps added, so that the traversal can continue
+    def __reopen(self):
+        if self.__cur_best is not None:
+            self.best_players_history.pop()
+        for user in self.__current_streak.keys():
+            self.streaks[user].pop()
+
+    def __report_timings(self, profile: bool):
+        for name, duration in self.stage_timings.items():
+            metrics.observe("analytics_stage_seconds", duration, stage=name)
+        report = ", ".join(f"{name} = {duration:.3f}s" for name, duration in self.stage_timings.items())
+        if not profile:
+            report += " (set ANALYTICS_PROFILE=TRUE to time every stage inside the traversal)"
+        logger.info(f"[Analytics] Stage timings: {report}")
+
+    def __build(self, dataset: Dataset):
         deltas = dataset.deltas
         logger.info(f"[Analytics] Starting building analytics from {len(deltas)} deltas")
-        self.__list_users(dataset)
-        self.__check_deltas(dataset)
-        self.__calculate_user_length_histories(dataset)
-        self.__calculate_user_deltas(dataset)
-        self.__calculate_best_players_history(dataset)
-        self.__calculate_streaks(dataset)
+        self.__reset()
+        self.__traverse(deltas.instances())
+        self.build_user_summaries()
+        self.version = next_analytics_version()
         logger.info(f"[Analytics] Done buildng all analytics")
 
+    # The lock can't be saved, a loaded snapshot gets a new one. It also gets a new version, since
+    # versions are only unique within a process, and the last leader period is extended until now
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = RLock()
+        self.version = next_analytics_version()
+        if len(self.best_players_history) > 0:
+            user, start, _ = self.best_players_history[-1]
+            self.best_players_history[-1] = (user, start, datetime.now(timezone.utc))
+
+    def __init__(self, dataset: Dataset):
+        # Held by readers and by updates, so nobody sees analytics in the middle of an update
+        self.lock = RLock()
+        self.__build(dataset)
+
+    # Continues from the current state when deltas were only appended, appended_from being the index
+    # of the first new delta. None means that earlier deltas changed, so everything is built again
+    def update(self, dataset: Dataset, appended_from: int):
+        with self.lock:
+            if appended_from is None:
+                self.__build(dataset)
+                return
+            logger.info(f"[Analytics] Extending analytics with {len(dataset.deltas) - appended_from} new deltas")
+            self.__reopen()
+            self.__traverse(dataset.deltas.instances(appended_from))
+            self.build_user_summaries()
+            self.version = next_analytics_version()
+            logger.info(f"[Analytics] Done extending analytics")
+
+    # Best and last streak of the user
+    def summarize_streaks(self, user: str) -> tuple[tuple[datetime, datetime, int], tuple[datetime, datetime, int]]:
+        streaks = self.streaks[user]
+        return max(streaks, key=lambda streak: streak[2]), streaks[-1]
+
+    def build_user_summaries(self):
+        calendar = get_calendar()
+        self.user_summaries: dict[str, UserSummary] = {}
+        for user in self.users:
+            best_streak, last_streak = self.summarize_streaks(user)
+            self.user_summaries[user] = UserSummary(
+                user,
+                self.get_user_length(user),
+                self.get_user_best_rank(user),
+                self.get_user_events_count(user),
+                self.get_user_average_interval(user),
+                best_streak,
+                last_streak[2],
+                calendar.day_end(last_streak[1].timestamp()),
+            )
+
+    def get_user_summaries(self) -> dict[str, UserSummary]:
+        now = datetime.now(timezone.utc).timestamp()
+        for summary in self.user_summaries.values():
+            summary.refresh(now)
+        return self.user_summaries
+
     def get_users(self) -> set[str]:
         return self.users
 
@@ -137,8 +274,12 @@ class Analytics:
             return 0
         return history[-1][1] if len(history) > 0 else 0
     
-    def get_user_length_history(self, user: str) -> list[tuple[datetime, int]]:
-        return self.user_length_histories[user]
+    # The closest entries outside of the window are included, since they give the length at its edges
+    def get_user_length_history(self, user: str, start: datetime = None, end: datetime = None) -> list[tuple[datetime, int]]:
+        history = self.user_length_histories[user]
+        if start is None and end is None:
+            return history
+        return time_window(history, start, end, neighbours=True)
     
     def get_user_best_rank(self, user: str) -> int:
         return self.best_rank[user]
@@ -155,10 +296,22 @@ class Analytics:
         return duration / count
         
     def get_user_best_streak(self, user: str) -> tuple[datetime, datetime, int]:
-        return max(self.streaks.get(user), key=lambda streak: streak[2])
+        return self.user_summaries[user].best_streak
+
+    def get_user_deltas(self, user: str, start: datetime = None, end: datetime = None) -> list[tuple[datetime, int]]:
+        deltas = self.user_deltas.get(user)
+        if deltas is None or (start is None and end is None):
+            return deltas
+        return time_window(deltas, start, end)
 
-    def get_user_deltas(self, user: str) -> list[tuple[datetime, int]]:
-        return self.user_deltas.get(user)
+    # Deltas of all users from start up to end, that is excluded like in time windows, in order of time
+    def get_deltas_between(self, start: datetime, end: datetime) -> list[tuple[str, datetime, int]]:
+        result = []
+        for user in self.users:
+            result.extend((user,) + delta for delta in time_window(self.get_user_deltas(user), start, end) if delta[0] < end)
+        # Deltas of one time are ordered by user, like in the database
+        result.sort(key=lambda entry: (entry[1], entry[0]))
+        return result
     
     def get_all_deltas(self) -> list[tuple[str, datetime, int]]:
         result = []
@@ -168,16 +321,26 @@ class Analytics:
     
     def get_best_players_history(self):
         return self.best_players_history
+
+    # Leader periods, that overlap the window
+    def get_best_players_between(self, start: datetime, end: datetime) -> list[tuple[str, datetime, datetime]]:
+        return [entry for entry in self.best_players_history if entry[2] > start and entry[1] < end]
     
     def get_user_streaks(self, user: str) -> list[tuple[datetime, datetime, int]]:
         return self.streaks.get(user)
     
     def get_user_current_streak(self, user: str) -> int:
-        streak = self.streaks.get(user)[-1]
-        deadline = next_pesun_date(streak[1])
-        now = datetime.now(timezone.utc)
-        return streak[2] if now <= deadline else 0
+        summary = self.user_summaries[user]
+        summary.refresh(datetime.now(timezone.utc).timestamp())
+        return summary.current_streak
     
+    # Timestamps and lengths of every user as arrays, that time windows are looked up in
+    def get_window_events(self) -> dict[str, UserEvents]:
+        return {user: UserEvents.from_history(history) for user, history in self.user_length_histories.items()}
+
+    def get_window_index(self) -> WindowIndex:
+        return WindowIndex(self.get_window_events(), self.best_players_history)
+
     def get_user_domination_durations(self) -> dict[str, timedelta]:
         durations = {}
         for entry in self.best_players_history:
@@ -187,5 +350,17 @@ class Analytics:
             durations[user] = total_duration
         return durations
     
+def analytics_class() -> type[Analytics]:
+    backend = os.getenv("ANALYTICS_BACKEND", "python").lower()
+    if backend == "numpy":
+        from vector_analytics import VectorAnalytics
+        return VectorAnalytics
+    if backend == "sqlite":
+        from sql_analytics import SqlAnalytics
+        return SqlAnalytics
+    if backend != "python":
+        logger.warning(f"[Analytics] Unknown analytics backend {backend}, using python")
+    return Analytics
+
 def build_analytics(dataset: Dataset) -> Analytics:
-    return Analytics(dataset)
+    return analytics_class()(dataset)
@@ -0,0 +1,68 @@
+// Renders the user statistics in the browser from the data store, used when CLIENTSIDE_STATISTICS=TRUE
+const DAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"];
+
+function formatPlural(value, name) {
+    return `${value} ${name}${value === 1 ? "" : "s"}`;
+}
+
+function formatRounded(value) {
+    const rounded = Math.round(value * 100) / 100;
+    return Number.isInteger(rounded) ? rounded.toFixed(1) : `${rounded}`;
+}
+
+function histogramFigure(x, title, xTitle, template, extra) {
+    const trace = Object.assign({
+        type: "histogram",
+        x: x,
+        marker: {color: "DeepSkyBlue"},
+        name: "",
+    }, extra.trace || {});
+    const layout = Object.assign({
+        template: template,
+        title: {text: title},
+        xaxis: {title: {text: xTitle}},
+        yaxis: {title: {text: "count"}},
+        barmode: "relative",
+    }, extra.layout || {});
+    return {data: [trace], layout: layout};
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    user_statistics: {
+        // Times are wall clock seconds, so UTC getters give the local day and hour of the event
+        events: function(user, data) {
+            const userData = data.users[user];
+            const dates = userData.times.map(time => new Date(time * 1000));
+            const days = dates.map(date => DAY_NAMES[(date.getUTCDay() + 6) % 7]);
+            const hours = dates.map(date => date.getUTCHours());
+            const customdata = [...Array(24).keys()].map(hour => (hour + 1) % 24);
+            return [
+                histogramFigure(days, "Events by Day", "Day", data.template, {
+                    layout: {xaxis: {title: {text: "Day"}, categoryorder: "array", categoryarray: DAY_NAMES}},
+                }),
+                histogramFigure(hours, "Events by Hour", "Hour", data.template, {
+                    trace: {
+                        nbinsx: 24,
+                        customdata: customdata,
+                        hovertemplate: "Interval: %{x:02d}:00 - %{customdata:02d}:00<br>Count: %{y}<extra></extra>",
+                    },
+                }),
+                histogramFigure(userData.deltas, "Events by Delta", "Delta", data.template, {
+                    trace: {nbinsx: 16},
+                }),
+            ];
+        },
+        numerics: function(user, data) {
+            const userData = data.users[user];
+            const intervalDays = formatRounded(userData.average_interval / (60 * 60 * 24));
+            const currentStreak = Date.now() / 1000 <= userData.streak_deadline ? userData.last_streak : 0;
+            return [
+                `#${userData.best_rank}`,
+                userData.events_count,
+                `${intervalDays} days`,
+                formatPlural(userData.best_streak, "day"),
+                formatPlural(currentStreak, "day"),
+            ];
+        },
+    },
+});
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import perf_counter
+
+# Times every step from parsing a synthetic archive to building dashboard figures at several sizes.
+# Every size is measured in a fresh process, so the peak memory of one size doesn't hide another
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+def peak_rss_mb() -> float:
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class Measurements:
+    def __init__(self, events: int):
+        self.events = events
+        self.phases: list[dict] = []
+
+    def measure(self, name: str, action, events: int = None):
+        start = perf_counter()
+        result = action()
+        self.add(name, perf_counter() - start, events)
+        return result
+
+    def add(self, name: str, seconds: float, events: int = None):
+        events = self.events if events is None else events
+        self.phases.append({
+            "phase": name,
+            "seconds": seconds,
+            "events_per_second": events / seconds if seconds > 0 else None,
+            "peak_rss_mb": peak_rss_mb(),
+        })
+
+def measure_archive(archive: Path, backend: str) -> dict:
+    os.environ["ANALYTICS_BACKEND"] = backend
+    os.environ["ANALYTICS_PROFILE"] = "TRUE"
+    from parse_archive import parse_archive
+    import dataset as dataset_cache
+    import snapshot
+    from analytics import build_analytics
+
+    dataset = parse_archive(archive)
+    measurements = Measurements(len(dataset.deltas))
+    # Parsed once more for the timing, the first run also warms up imports and the calendar
+    measurements.measure("parse_archive", lambda: parse_archive(archive))
+    measurements.measure("dataset.save", lambda: dataset_cache.save_dataset(dataset))
+    measurements.measure("dataset.load", dataset_cache.load_dataset)
+    analytics = measurements.measure("analytics.build", lambda: build_analytics(dataset))
+    for name, seconds in analytics.stage_timings.items():
+        measurements.add(f"analytics.{name}", seconds)
+    measurements.measure("snapshot.save", lambda: snapshot.save_snapshot(analytics, dataset))
+    measurements.measure("snapshot.load", lambda: snapshot.load_snapshot(dataset))
+
+    import plotter
+    from figure_cache import serialize_figure
+    from multi_chat import Chat
+    measurements.measure("dash.create_app", lambda: plotter.create_app([Chat("benchmark", archive, analytics)]))
+    user = max(analytics.get_users(), key=analytics.get_user_events_count)
+    user_events = analytics.get_user_events_count(user)
+    leader_timeline = plotter.LeaderTimeline(analytics.get_best_players_history())
+    colors = plotter.leader_colors(leader_timeline)
+    index = measurements.measure("window_index.build", analytics.get_window_index)
+    window_end = datetime.fromtimestamp(index.last, timezone.utc)
+    callbacks = {
+        "update_user_length": (lambda: serialize_figure(plotter.user_length_figure(analytics, user)), user_events),
+        "update_user_numerics": (lambda: analytics.get_user_summaries()[user], 1),
+        "update_user_events": (lambda: plotter.serialize_figures(plotter.user_events_figures(analytics, user)), user_events),
+        "update_best_player_history": (lambda: serialize_figure(plotter.best_player_history_figure(leader_timeline, colors)), None),
+        "update_time_window": (lambda: plotter.serialize_figures(plotter.time_window_figures(index, window_end - timedelta(days=30), window_end)), None),
+        "refresh_pie": (lambda: (serialize_figure(plotter.top_player_pie_figure(analytics)), serialize_figure(plotter.events_pie_figure(analytics))), None),
+    }
+    for name, (callback, events) in callbacks.items():
+        measurements.measure(f"dash.{name}", callback, events)
+    return {"events": measurements.events, "backend": backend, "phases": measurements.phases}
+
+def run_size(size: int, backend: str, work: Path, seed: int, format: str = "html") -> dict:
+    from synthetic import generate_archive
+    archive = work / f"archive_{size}_{seed}_{format}"
+    marker = archive / ".complete"
+    if not marker.exists():
+        print(f"Generating archive with {size} events", file=sys.stderr)
+        generate_archive(archive, size, seed=seed, format=format)
+        marker.touch()
+    run_folder = work / f"run_{size}_{backend}_{format}"
+    os.makedirs(run_folder, exist_ok=True)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH")]))
+    command = [sys.executable, os.path.abspath(__file__), "--measure", str(archive.resolve()), "--backends", backend]
+    output = subprocess.run(command, cwd=run_folder, env=env, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["format"] = format
+    return result
+
+def print_results(results: list[dict]):
+    for result in results:
+        print(f"{result["events"]} events, {result["backend"]} backend, {result.get("format", "html")} export")
+        print(f"  {"phase":<32} {"seconds":>10} {"events/s":>12} {"peak MB":>9}")
+        for phase in result["phases"]:
+            throughput = phase["events_per_second"]
+            throughput = f"{throughput:>12.0f}" if throughput is not None else f"{"-":>12}"
+            print(f"  {phase["phase"]:<32} {phase["seconds"]:>10.4f} {throughput} {phase["peak_rss_mb"]:>9.1f}")
+
+# Phases, that became slower than in the baseline by more than the tolerance
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    previous = {(result["events"], result["backend"], result.get("format", "html"), phase["phase"]): phase["seconds"] for result in baseline for phase in result["phases"]}
+    regressions = []
+    for result in results:
+        for phase in result["phases"]:
+            before = previous.get((result["events"], result["backend"], result.get("format", "html"), phase["phase"]))
+            # Very short phases are mostly noise
+            if before is None or before < 0.01:
+                continue
+            if phase["seconds"] > before * (1 + tolerance):
+                regressions.append(f"{result["events"]} events, {result["backend"]}, {result.get("format", "html")}: {phase["phase"]} {before:.3f}s -> {phase["seconds"]:.3f}s")
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark parsing, caching, analytics and dashboard callbacks on synthetic archives")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of events, up to 10000000")
+    parser.add_argument("--backends", nargs="+", default=["python", "numpy"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--formats", nargs="+", choices=["html", "json"], default=["html"], help="formats of generated exports")
+    parser.add_argument("--work", default="benchmark_data", help="folder for generated archives and caches")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure is not None:
+        print(json.dumps(measure_archive(Path(args.measure), args.backends[0])))
+        return 0
+    work = Path(args.work)
+    os.makedirs(work, exist_ok=True)
+    results = []
+    for size in args.sizes:
+        for format in args.formats:
+            for backend in args.backends:
+                results.append(run_size(size, backend, work, args.seed, format))
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+from pathlib import Path
+import hashlib
+
+# Folder with caches of the chat being processed. When several chats are analyzed,
+# every chat gets its own folder, set in the worker that processes it
+__folder = Path('cache')
+
+def cache_folder() -> Path:
+    return __folder
+
+def cache_path(name: str) -> Path:
+    return __folder / name
+
+def set_cache_folder(folder: Path):
+    global __folder
+    __folder = Path(folder)
+
+# Archives with the same folder name in different places get different folders
+def chat_cache_folder(archive_name: str) -> Path:
+    path = Path(archive_name).resolve()
+    digest = hashlib.sha1(str(path).encode()).hexdigest()[:8]
+    return Path('cache') / 'chats' / f"{path.name}-{digest}"
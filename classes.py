@@ -1,4 +1,7 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+import numpy as np
+import hashlib
 
 class DeltaInstance:
     def __init__(self, user: str, timestamp: datetime, delta: int, wait_minutes: int = None, is_reset: bool = False, new_length: int = None):
@@ -9,7 +12,147 @@ class DeltaInstance:
         self.is_reset = is_reset
         self.new_length = new_length
 
+# Marks missing values in integer columns
+MISSING_VALUE = -2**31
+
+__timezones: dict[int, timezone] = {}
+
+def offset_timezone(offset_minutes: int) -> timezone:
+    tz = __timezones.get(offset_minutes)
+    if tz is None:
+        tz = timezone(timedelta(minutes=offset_minutes))
+        __timezones[offset_minutes] = tz
+    return tz
+
+def missing_to_none(value: int) -> int:
+    return None if value == MISSING_VALUE else value
+
+# Read-only view of one row of a DeltaTable, for code that expects a DeltaInstance
+class DeltaRow:
+    __slots__ = ("table", "index")
+
+    def __init__(self, table: "DeltaTable", index: int):
+        self.table = table
+        self.index = index
+
+    @property
+    def user(self) -> str:
+        return self.table.users[self.table.user_ids[self.index]]
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(int(self.table.timestamps[self.index]), offset_timezone(int(self.table.offsets[self.index])))
+
+    @property
+    def delta(self) -> int:
+        return int(self.table.deltas[self.index])
+
+    @property
+    def wait_minutes(self) -> int:
+        return missing_to_none(int(self.table.wait_minutes[self.index]))
+
+    @property
+    def is_reset(self) -> bool:
+        return bool(self.table.is_resets[self.index])
+
+    @property
+    def new_length(self) -> int:
+        return missing_to_none(int(self.table.new_lengths[self.index]))
+
+# Deltas stored as columns: epoch timestamps with their UTC offsets in minutes, user ids
+# pointing into the users list, and missing values marked with MISSING_VALUE
+class DeltaTable:
+    def __init__(self, users: list[str], timestamps: np.ndarray, offsets: np.ndarray, user_ids: np.ndarray, deltas: np.ndarray, wait_minutes: np.ndarray, new_lengths: np.ndarray, is_resets: np.ndarray):
+        self.users = users
+        self.timestamps = timestamps
+        self.offsets = offsets
+        self.user_ids = user_ids
+        self.deltas = deltas
+        self.wait_minutes = wait_minutes
+        self.new_lengths = new_lengths
+        self.is_resets = is_resets
+
+    @staticmethod
+    def from_instances(instances: list[DeltaInstance]) -> "DeltaTable":
+        user_ids: dict[str, int] = {}
+        def get_user_id(user: str) -> int:
+            user_id = user_ids.get(user)
+            if user_id is None:
+                user_id = len(user_ids)
+                user_ids[user] = user_id
+            return user_id
+        def optional(value: int) -> int:
+            return MISSING_VALUE if value is None else value
+        ids = np.array([get_user_id(delta.user) for delta in instances], dtype=np.int32)
+        return DeltaTable(
+            list(user_ids.keys()),
+            np.array([int(delta.timestamp.timestamp()) for delta in instances], dtype=np.int64),
+            np.array([int(delta.timestamp.utcoffset().total_seconds()) // 60 for delta in instances], dtype=np.int16),
+            ids,
+            np.array([delta.delta for delta in instances], dtype=np.int32),
+            np.array([optional(delta.wait_minutes) for delta in instances], dtype=np.int32),
+            np.array([optional(delta.new_length) for delta in instances], dtype=np.int32),
+            np.array([delta.is_reset for delta in instances], dtype=np.uint8),
+        )
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, index: int) -> DeltaRow:
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("DeltaTable index out of range")
+        return DeltaRow(self, index)
+
+    def __iter__(self) -> Iterator[DeltaRow]:
+        for index in range(len(self)):
+            yield DeltaRow(self, index)
+
+    # Builds short-lived DeltaInstance objects row by row, which is much faster than going through views
+    def instances(self, start: int = 0) -> Iterator[DeltaInstance]:
+        users = self.users
+        rows = zip(
+            self.timestamps[start:].tolist(), self.offsets[start:].tolist(), self.user_ids[start:].tolist(), self.deltas[start:].tolist(),
+            self.wait_minutes[start:].tolist(), self.new_lengths[start:].tolist(), self.is_resets[start:].tolist(),
+        )
+        for timestamp, offset, user_id, delta, wait_minutes, new_length, is_reset in rows:
+            yield DeltaInstance(
+                users[user_id],
+                datetime.fromtimestamp(timestamp, offset_timezone(offset)),
+                delta,
+                missing_to_none(wait_minutes),
+                bool(is_reset),
+                missing_to_none(new_length),
+            )
+
+    def to_instances(self) -> list[DeltaInstance]:
+        return list(self.instances())
+
+    # Hash of the whole content, identifies results computed from this table
+    def fingerprint(self) -> str:
+        digest = hashlib.sha1("\n".join(self.users).encode())
+        for column in [self.timestamps, self.offsets, self.user_ids, self.deltas, self.wait_minutes, self.new_lengths, self.is_resets]:
+            digest.update(np.ascontiguousarray(column).tobytes())
+        return digest.hexdigest()
+
+    # True when the other table starts with exactly the rows of this one. User ids of
+    # the tables may differ, so users are compared by name
+    def is_prefix_of(self, other: "DeltaTable") -> bool:
+        n = len(self)
+        if n > len(other):
+            return False
+        if n == 0:
+            return True
+        columns = ["timestamps", "offsets", "deltas", "wait_minutes", "new_lengths", "is_resets"]
+        for column in columns:
+            if not np.array_equal(getattr(self, column), getattr(other, column)[:n]):
+                return False
+        users = np.array(self.users, dtype=object)[self.user_ids]
+        other_users = np.array(other.users, dtype=object)[other.user_ids[:n]]
+        return bool(np.array_equal(users, other_users))
+
 class Dataset:
-    def __init__(self, deltas: list[DeltaInstance], unknown_users: list[str]):
+    def __init__(self, deltas: DeltaTable, unknown_users: list[str]):
         self.deltas = deltas
-        self.unknown_users = unknown_users
\ No newline at end of file
+        self.unknown_users = unknown_users
@@ -0,0 +1,259 @@
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+from analytics import Analytics
+from classes import Dataset
+import user_options
+
+# Modules of the dashboard, that the headless commands must never import
+DASHBOARD_MODULES = ["dash", "plotly", "pandas", "flask"]
+
+def __date(date: datetime) -> str:
+    return date.isoformat()
+
+# Users with the same length are ordered by name, so that ranks don't change between runs
+def leaderboard(analytics: Analytics) -> list[dict]:
+    lengths = {user: analytics.get_user_length(user) for user in analytics.get_users()}
+    users = sorted(lengths.keys(), key=lambda user: (-lengths[user], user))
+    return [{"rank": rank, "user": user, "length": lengths[user]} for rank, user in enumerate(users, start=1)]
+
+def user_stats(analytics: Analytics) -> list[dict]:
+    result = []
+    for user, summary in sorted(analytics.get_user_summaries().items()):
+        start, end, count = summary.best_streak
+        result.append({
+            "user": user,
+            "length": summary.length,
+            "best_rank": summary.best_rank,
+            "events": summary.events_count,
+            "average_interval_days": round(summary.average_interval.total_seconds() / (60 * 60 * 24), 2),
+            "best_streak": {"days": count, "start": __date(start), "end": __date(end)},
+            "current_streak": summary.current_streak,
+        })
+    return result
+
+def leader_durations(analytics: Analytics) -> list[dict]:
+    durations = sorted(analytics.get_user_domination_durations().items(), key=lambda entry: entry[1], reverse=True)
+    return [{"user": user, "seconds": int(duration.total_seconds())} for user, duration in durations]
+
+def report(analytics: Analytics) -> dict:
+    return {
+        "leaderboard": leaderboard(analytics),
+        "users": user_stats(analytics),
+        "leader_durations": leader_durations(analytics),
+    }
+
+def print_report(data: dict):
+    print("Leaderboard")
+    for entry in data["leaderboard"]:
+        print(f"{entry["rank"]:>4}. {entry["user"]:<24} {entry["length"]}")
+    print()
+    print("Users")
+    for entry in data["users"]:
+        streak = entry["best_streak"]
+        print(f"- {entry["user"]}: length {entry["length"]}, best rank #{entry["best_rank"]}, {entry["events"]} events, "
+            f"every {entry["average_interval_days"]} days, longest streak {streak["days"]} days, current streak {entry["current_streak"]} days")
+    print()
+    print("Time as best player")
+    for entry in data["leader_durations"]:
+        print(f"- {entry["user"]}: {round(entry["seconds"] / (60 * 60 * 24), 1)} days")
+
+def cross_chat_report(chats: list) -> dict:
+    from multi_chat import CrossChatAnalytics
+    cross_chat = CrossChatAnalytics(chats)
+    return {
+        "chats": cross_chat.chats,
+        "leaderboard": [{
+            "rank": rank,
+            "user": totals.user,
+            "length": totals.length,
+            "events": totals.events_count,
+            "best_rank": totals.best_rank,
+            "leader_seconds": int(totals.leader_duration.total_seconds()),
+            "chat_lengths": totals.chat_lengths,
+        } for rank, totals in enumerate(cross_chat.leaderboard(), start=1)],
+        "per_chat": {chat.name: report(chat.analytics) for chat in chats},
+    }
+
+def print_cross_chat_report(data: dict):
+    print(f"All chats: {", ".join(data["chats"])}")
+    for entry in data["leaderboard"]:
+        lengths = ", ".join(f"{chat} {length}" for chat, length in entry["chat_lengths"].items())
+        print(f"{entry["rank"]:>4}. {entry["user"]:<24} {entry["length"]} ({lengths})")
+    for chat, chat_data in data["per_chat"].items():
+        print()
+        print(f"=== {chat} ===")
+        print_report(chat_data)
+
+def load_analytics(archive: str) -> tuple[Dataset, Analytics]:
+    from dataset import get_dataset
+    from snapshot import get_analytics
+    import messenger
+    # An archive given on the command line is used once, the saved one stays for the dashboard
+    user_options.read_options()
+    dataset = get_dataset(archive)
+    if len(dataset.unknown_users) > 0:
+        messenger.notify_unknown_users(dataset.unknown_users)
+    return dataset, get_analytics(dataset)
+
+# Archives given on the command line, or the saved ones
+def __archives(args: argparse.Namespace) -> list[str]:
+    if args.archive:
+        return args.archive
+    user_options.read_options()
+    return user_options.options.archive_names
+
+def command_report(args: argparse.Namespace) -> int:
+    # Progress messages go to stderr, so that stdout has only the JSON
+    output = sys.stderr if args.json else sys.stdout
+    archives = __archives(args)
+    if len(archives) > 1:
+        with contextlib.redirect_stdout(output):
+            from multi_chat import analyze_chats
+            chats = analyze_chats(archives)
+        data, print_data = cross_chat_report(chats), print_cross_chat_report
+    else:
+        with contextlib.redirect_stdout(output):
+            _, analytics = load_analytics(archives[0] if len(archives) > 0 else None)
+        data, print_data = report(analytics), print_report
+    if args.json:
+        json.dump(data, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_data(data)
+    return 0
+
+def window_report(analytics: Analytics, start: str, end: str, events: bool = False) -> dict:
+    from window_index import day_start, day_end
+    index = analytics.get_window_index()
+    statistics = sorted(index.statistics(day_start(start), day_end(end)).values(), key=lambda entry: entry.gain, reverse=True)
+    data = {
+        "start": start,
+        "end": end,
+        "users": [{
+            "user": entry.user,
+            "gain": entry.gain,
+            "length": entry.length,
+            "events": entry.events_count,
+            "average_interval_days": round(entry.average_interval.total_seconds() / (60 * 60 * 24), 2),
+            "leader_seconds": int(entry.leader_duration.total_seconds()),
+        } for entry in statistics],
+    }
+    if events:
+        data["events"] = [{"user": user, "date": __date(date), "delta": delta} for user, date, delta in analytics.get_deltas_between(day_start(start), day_end(end))]
+    return data
+
+def print_window_report(data: dict):
+    print(f"From {data["start"]} to {data["end"]}")
+    for entry in data["users"]:
+        print(f"- {entry["user"]}: gained {entry["gain"]} to {entry["length"]}, {entry["events"]} events, "
+            f"every {entry["average_interval_days"]} days, best player for {round(entry["leader_seconds"] / (60 * 60 * 24), 1)} days")
+    if "events" in data:
+        print()
+        print("Events")
+        for entry in data["events"]:
+            print(f"- {entry["date"]} {entry["user"]} {entry["delta"]:+d}")
+
+def print_chats_window_report(data: dict):
+    for index, (chat, chat_data) in enumerate(data["per_chat"].items()):
+        if index > 0:
+            print()
+        print(f"=== {chat} ===")
+        print_window_report(chat_data)
+
+def command_window(args: argparse.Namespace) -> int:
+    output = sys.stderr if args.json else sys.stdout
+    archives = __archives(args)
+    if len(archives) > 1:
+        with contextlib.redirect_stdout(output):
+            from multi_chat import analyze_chats
+            chats = analyze_chats(archives)
+        data = {"per_chat": {chat.name: window_report(chat.analytics, args.start, args.end, args.events) for chat in chats}}
+        print_data = print_chats_window_report
+    else:
+        with contextlib.redirect_stdout(output):
+            _, analytics = load_analytics(archives[0] if len(archives) > 0 else None)
+        data, print_data = window_report(analytics, args.start, args.end, args.events), print_window_report
+    if args.json:
+        json.dump(data, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_data(data)
+    return 0
+
+def command_migrate(args: argparse.Namespace) -> int:
+    import main
+    from cache_folder import chat_cache_folder, set_cache_folder
+    archives = __archives(args)
+    if len(archives) <= 1:
+        main.migrate_to_db(*load_analytics(archives[0] if len(archives) > 0 else None))
+        return 0
+    from dataset import get_dataset
+    from snapshot import get_analytics
+    # Every chat has its own database in its cache folder
+    for archive in archives:
+        set_cache_folder(chat_cache_folder(archive))
+        dataset = get_dataset(archive)
+        main.migrate_to_db(dataset, get_analytics(dataset))
+    return 0
+
+def command_dashboard(args: argparse.Namespace) -> int:
+    import main
+    main.main(args.archive)
+    return 0
+
+# Imports the headless entry point in a fresh interpreter, fails when it takes longer than
+# the budget or pulls in any of the dashboard modules
+def command_check_imports(args: argparse.Namespace) -> int:
+    code = (
+        "import time, sys, json\n"
+        "start = time.perf_counter()\n"
+        "import cli\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"loaded = [name for name in {DASHBOARD_MODULES!r} if name in sys.modules]\n"
+        "print(json.dumps({'seconds': elapsed, 'loaded': loaded}))\n"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH")]))
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    budget = args.budget_ms / 1000
+    ok = result["seconds"] <= budget and len(result["loaded"]) == 0
+    print(f"Import time {result["seconds"] * 1000:.0f} ms, budget {args.budget_ms} ms")
+    if len(result["loaded"]) > 0:
+        print(f"Dashboard modules imported: {", ".join(result["loaded"])}")
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+def main() -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Pesun analytics without the dashboard")
+    parser.add_argument("--archive", action="append", help="path of the archive, the saved one is used by default. Repeat to analyze several chats")
+    commands = parser.add_subparsers(dest="command")
+    report_parser = commands.add_parser("report", help="print the leaderboard, user statistics and leader durations")
+    report_parser.add_argument("--json", action="store_true", help="print JSON instead of text")
+    report_parser.set_defaults(handler=command_report)
+    window_parser = commands.add_parser("window", help="print statistics of users between two dates, both included")
+    window_parser.add_argument("--start", required=True, help="first day, YYYY-MM-DD")
+    window_parser.add_argument("--end", required=True, help="last day, YYYY-MM-DD")
+    window_parser.add_argument("--events", action="store_true", help="list every event of the window too")
+    window_parser.add_argument("--json", action="store_true", help="print JSON instead of text")
+    window_parser.set_defaults(handler=command_window)
+    migrate_parser = commands.add_parser("migrate", help="save deltas, users, handles and leader periods into the SQLite database")
+    migrate_parser.set_defaults(handler=command_migrate)
+    dashboard_parser = commands.add_parser("dashboard", help="start the dashboard")
+    dashboard_parser.set_defaults(handler=command_dashboard)
+    check_parser = commands.add_parser("check-imports", help="check that the headless entry point starts fast")
+    check_parser.add_argument("--budget-ms", type=int, default=int(os.getenv("IMPORT_BUDGET_MS", "500")))
+    check_parser.set_defaults(handler=command_check_imports)
+    parser.set_defaults(handler=command_report, json=False)
+    args = parser.parse_args()
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
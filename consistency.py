@@ -0,0 +1,167 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# Checks on a seeded synthetic export, that the different ways of getting the same result agree:
+# lexer and BeautifulSoup parsing, serial and parallel parsing, HTML and JSON exports, incremental
+# and full analytics builds, the python, numpy and sqlite analytics backends and their time windows,
+# and the archive watcher
+
+def table_rows(table) -> list[tuple]:
+    return [(delta.user, delta.timestamp, delta.delta, delta.wait_minutes, delta.is_reset, delta.new_length) for delta in table.instances()]
+
+# Everything analytics answer, except the end of the last leader period, which is the time of the build
+def describe_analytics(analytics) -> list:
+    result = []
+    for user in sorted(analytics.get_users()):
+        result.append((
+            user,
+            analytics.get_user_length(user),
+            analytics.get_user_best_rank(user),
+            analytics.get_user_events_count(user),
+            analytics.get_user_average_interval(user),
+            analytics.get_user_best_streak(user),
+            analytics.get_user_current_streak(user),
+            list(analytics.get_user_length_history(user)),
+            list(analytics.get_user_deltas(user)),
+            list(analytics.get_user_streaks(user)),
+        ))
+    history = analytics.get_best_players_history()
+    result.append(list(history[:-1]) + [history[-1][:2]] if len(history) > 0 else [])
+    return result
+
+# Statistics of time windows and their deltas. Durations are rounded, since backends sum them in different orders
+def describe_windows(analytics, windows: list[tuple[datetime, datetime]]) -> list:
+    index = analytics.get_window_index()
+    result = [index.first, index.last]
+    for start, end in windows:
+        statistics = sorted(index.statistics(start, end).values(), key=lambda entry: entry.user)
+        result.append([(
+            entry.user,
+            entry.length,
+            entry.gain,
+            entry.events_count,
+            round(entry.average_interval.total_seconds(), 3),
+            round(entry.leader_duration.total_seconds(), 3),
+        ) for entry in statistics])
+        result.append(sorted((user, round(duration.total_seconds(), 3)) for user, duration in index.domination_durations(start, end).items()))
+        result.append(analytics.get_deltas_between(start, end))
+    return result
+
+# The middle third of the history, and all of it
+def test_windows(analytics) -> list[tuple[datetime, datetime]]:
+    index = analytics.get_window_index()
+    first, last = datetime.fromtimestamp(index.first, timezone.utc), datetime.fromtimestamp(index.last, timezone.utc)
+    third = (last - first) / 3
+    return [(first + third, last - third), (first, last + timedelta(days=1))]
+
+class Checks:
+    def __init__(self):
+        self.failed: list[str] = []
+
+    def check(self, name: str, passed: bool):
+        print(f"{name:<48} {"OK" if passed else "FAILED"}")
+        if not passed:
+            self.failed.append(name)
+
+def parse(archive: Path, mode: str = "lexer", workers: int = 1):
+    from parse_archive import parse_archive
+    os.environ["PARSE_MODE"] = mode
+    return parse_archive(archive, workers).deltas
+
+def check_parsing(checks: Checks, html_archive: Path, json_archive: Path):
+    rows = table_rows(parse(html_archive))
+    checks.check("lexer and soup parsing", rows == table_rows(parse(html_archive, "soup")))
+    checks.check("serial and parallel parsing", rows == table_rows(parse(html_archive, workers=2)))
+    checks.check("HTML and JSON exports", rows == table_rows(parse(json_archive)))
+    # A broken message in the middle of the export costs at most its own delta
+    broken_archive = json_archive.with_name("archive_json_broken")
+    shutil.copytree(json_archive, broken_archive)
+    lines = (json_archive / "result.json").read_text(encoding="utf-8").split("\n")
+    lines[len(lines) // 2] = lines[len(lines) // 2].replace('"type": "message"', '"type": "message" "broken"', 1)
+    (broken_archive / "result.json").write_text("\n".join(lines), encoding="utf-8")
+    broken_rows = table_rows(parse(broken_archive))
+    checks.check("JSON export with a malformed message", len(broken_rows) >= len(rows) - 1 and broken_rows[-1] == rows[-1])
+
+def check_analytics(checks: Checks, archive: Path, work: Path):
+    from analytics import Analytics
+    from vector_analytics import VectorAnalytics
+    from sql_analytics import SqlAnalytics
+    from cache_folder import set_cache_folder
+    from classes import Dataset, DeltaTable
+    table = parse(archive)
+    dataset = Dataset(table, [])
+    half = len(table) // 2
+    half_dataset = Dataset(DeltaTable.from_instances(table.to_instances()[:half]), [])
+    python_analytics = Analytics(dataset)
+    expected = describe_analytics(python_analytics)
+    windows = test_windows(python_analytics)
+    expected_windows = describe_windows(python_analytics, windows)
+    for name, backend in [("python", Analytics), ("numpy", VectorAnalytics), ("sqlite", SqlAnalytics)]:
+        # Every backend gets its own caches, so the sqlite database is created from scratch
+        set_cache_folder(work / f"cache_{name}")
+        analytics = backend(dataset)
+        checks.check(f"{name} backend matches python", describe_analytics(analytics) == expected)
+        checks.check(f"{name} time windows match python", describe_windows(analytics, windows) == expected_windows)
+        set_cache_folder(work / f"cache_{name}_incremental")
+        analytics = backend(half_dataset)
+        analytics.update(dataset, half)
+        checks.check(f"{name} incremental update matches full build", describe_analytics(analytics) == expected)
+
+# The watcher gets the dataset memory-mapped from the cache, like after a restart, and the last page
+# of the export arrives later. Analytics must be extended from where they ended instead of rebuilt
+def check_watcher(checks: Checks, archive: Path, work: Path):
+    from analytics import Analytics
+    from cache_folder import set_cache_folder
+    from classes import Dataset
+    from dataset import get_dataset, load_dataset
+    from metrics import metrics
+    from parse_archive import list_message_files
+    from watcher import ArchiveWatcher
+    watched = work / "archive_watched"
+    shutil.copytree(archive, watched)
+    last_page = list_message_files(watched)[-1]
+    held_page = work / last_page.name
+    shutil.move(last_page, held_page)
+    set_cache_folder(work / "cache_watcher")
+    get_dataset(str(watched))
+    dataset = load_dataset()
+    cached_count = len(dataset.deltas)
+    analytics = Analytics(dataset)
+    shutil.move(held_page, last_page)
+    metrics.reset()
+    ArchiveWatcher(str(watched), dataset, analytics, 60).check()
+    extended = 'analytics_update_seconds_count{mode="extend"} 1' in metrics.render().splitlines()
+    checks.check("watcher extends analytics of a cached dataset", extended and len(analytics.get_all_deltas()) > cached_count)
+    expected = describe_analytics(Analytics(Dataset(parse(watched), [])))
+    checks.check("watcher update matches full build", describe_analytics(analytics) == expected)
+
+def main() -> int:
+    from synthetic import generate_archive
+    parser = argparse.ArgumentParser(description="Check that parsers and analytics backends agree on a synthetic export")
+    parser.add_argument("--events", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--work", help="folder for archives and caches, a temporary one by default")
+    args = parser.parse_args()
+    work = Path(args.work) if args.work else Path(tempfile.mkdtemp(prefix="pesun_consistency_"))
+    checks = Checks()
+    try:
+        html_archive = work / "archive_html"
+        json_archive = work / "archive_json"
+        generate_archive(html_archive, args.events, seed=args.seed)
+        generate_archive(json_archive, args.events, seed=args.seed, format="json")
+        check_parsing(checks, html_archive, json_archive)
+        check_analytics(checks, html_archive, work)
+        check_watcher(checks, html_archive, work)
+    finally:
+        if not args.work:
+            shutil.rmtree(work, ignore_errors=True)
+    print("OK" if len(checks.failed) == 0 else f"FAILED: {", ".join(checks.failed)}")
+    return 0 if len(checks.failed) == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+from classes import Dataset, DeltaTable, MISSING_VALUE, offset_timezone
+from manifest import load_manifest
+from metrics import metrics
+from logger import logger
+from cache_folder import cache_path
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from typing import Iterator
+import os
+import sqlite3
+
+# Increase when the schema changes, databases of older versions are created again
+DATABASE_VERSION = 1
+DATABASE_NAME = "pesun.db"
+# Rows inserted in one transaction while loading
+BATCH_SIZE = 50000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS deltas (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    timestamp INTEGER NOT NULL,
+    utc_offset INTEGER NOT NULL,
+    delta INTEGER NOT NULL,
+    wait_minutes INTEGER,
+    is_reset INTEGER NOT NULL,
+    new_length INTEGER,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS handles (handle TEXT PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users(id));
+CREATE TABLE IF NOT EXISTS leader_segments (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    start_time REAL NOT NULL,
+    start_offset INTEGER NOT NULL,
+    end_time REAL NOT NULL,
+    end_offset INTEGER NOT NULL
+);
+"""
+# Created after a bulk load, which is faster than updating them for every row
+INDEXES = """
+CREATE INDEX IF NOT EXISTS deltas_user_timestamp ON deltas(user_id, timestamp);
+CREATE INDEX IF NOT EXISTS deltas_timestamp ON deltas(timestamp);
+CREATE INDEX IF NOT EXISTS leader_segments_end ON leader_segments(end_time);
+"""
+DROP_INDEXES = """
+DROP INDEX IF EXISTS deltas_user_timestamp;
+DROP INDEX IF EXISTS deltas_timestamp;
+DROP INDEX IF EXISTS leader_segments_end;
+"""
+
+def __optional(value: int) -> int:
+    return None if value == MISSING_VALUE else value
+
+def offset_minutes(date: datetime) -> int:
+    return int(date.utcoffset().total_seconds()) // 60
+
+def to_datetime(timestamp: float, offset: int) -> datetime:
+    return datetime.fromtimestamp(timestamp, offset_timezone(offset))
+
+# Rows of the deltas table, with the length of the user after every delta. Lengths continue
+# from the given ones, so that appended deltas can be counted from where the table ended
+def delta_rows(table: DeltaTable, start: int, user_ids: list[int], lengths: dict[int, int]) -> Iterator[tuple]:
+    rows = zip(
+        table.timestamps[start:].tolist(), table.offsets[start:].tolist(), table.user_ids[start:].tolist(), table.deltas[start:].tolist(),
+        table.wait_minutes[start:].tolist(), table.is_resets[start:].tolist(), table.new_lengths[start:].tolist(),
+    )
+    for index, (timestamp, offset, user_index, delta, wait_minutes, is_reset, new_length) in enumerate(rows, start=start):
+        user_id = user_ids[user_index]
+        length = 0 if is_reset else lengths.get(user_id, 0) + delta
+        lengths[user_id] = length
+        yield (index, user_id, timestamp, offset, delta, __optional(wait_minutes), is_reset, __optional(new_length), length)
+
+def batches(rows: Iterator[tuple], size: int) -> Iterator[list[tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+# Handles resolved while parsing the last file of the archive, they include handles of every earlier file
+def saved_handles() -> dict[str, str]:
+    manifest = load_manifest()
+    if manifest is None or len(manifest.files) == 0:
+        return {}
+    return list(manifest.files.values())[-1].handles_after
+
+# Deltas, users, handles and leader segments in SQLite. Every process opens its own connection,
+# so the database can be used by pre-forked workers, and threads of one process share it under a lock
+class Database:
+    # The path is fixed when the database is created, so it stays in the cache folder of its chat
+    def __init__(self, path: Path = None):
+        self.path = Path(path) if path is not None else cache_path(DATABASE_NAME)
+        self.__lock = Lock()
+        self.__connection: sqlite3.Connection = None
+        self.__pid: int = None
+
+    def __getstate__(self) -> dict:
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["path"])
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__connection is not None and self.__pid == os.getpid():
+            return self.__connection
+        os.makedirs(self.path.parent, exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        if connection.execute("PRAGMA user_version").fetchone()[0] != DATABASE_VERSION:
+            logger.info(f"[Database] Creating database {self.path.name}")
+            for table in ["meta", "handles", "leader_segments", "deltas", "users"]:
+                connection.execute(f"DROP TABLE IF EXISTS {table}")
+            connection.executescript(SCHEMA + INDEXES)
+            connection.execute(f"PRAGMA user_version = {DATABASE_VERSION}")
+        self.__connection = connection
+        self.__pid = os.getpid()
+        return connection
+
+    def query(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        with self.__lock, metrics.span("database_query"):
+            return self.__connect().execute(sql, parameters).fetchall()
+
+    def fingerprint(self) -> str:
+        rows = self.query("SELECT value FROM meta WHERE key = 'fingerprint'")
+        return rows[0][0] if len(rows) > 0 else None
+
+    def __user_ids(self, connection: sqlite3.Connection, names: list[str]) -> list[int]:
+        connection.executemany("INSERT OR IGNORE INTO users (name) VALUES (?)", [(name,) for name in names])
+        ids = dict(connection.execute("SELECT name, id FROM users").fetchall())
+        return [ids[name] for name in names]
+
+    def __insert_deltas(self, connection: sqlite3.Connection, table: DeltaTable, start: int, user_ids: list[int], lengths: dict[int, int]):
+        for batch in batches(delta_rows(table, start, user_ids, lengths), BATCH_SIZE):
+            connection.execute("BEGIN")
+            connection.executemany("INSERT INTO deltas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            connection.execute("COMMIT")
+
+    def __write_handles(self, connection: sqlite3.Connection, handles: dict[str, str], fingerprint: str):
+        handles = {handle: user for handle, user in handles.items() if user is not None}
+        user_ids = self.__user_ids(connection, list(handles.values()))
+        connection.execute("BEGIN")
+        connection.execute("DELETE FROM handles")
+        connection.executemany("INSERT INTO handles VALUES (?, ?)", zip(handles.keys(), user_ids))
+        # Written last, so an interrupted load is never taken for a complete one
+        connection.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        connection.execute("COMMIT")
+
+    # Replaces everything with the dataset
+    def write_dataset(self, dataset: Dataset, handles: dict[str, str]):
+        table = dataset.deltas
+        logger.info(f"[Database] Loading {len(table)} deltas into {self.path.name}")
+        with self.__lock, metrics.span("database_load"):
+            connection = self.__connect()
+            connection.execute("BEGIN")
+            for name in ["meta", "handles", "leader_segments", "deltas", "users"]:
+                connection.execute(f"DELETE FROM {name}")
+            connection.execute("COMMIT")
+            connection.executescript(DROP_INDEXES)
+            self.__insert_deltas(connection, table, 0, self.__user_ids(connection, table.users), {})
+            connection.executescript(INDEXES)
+            self.__write_handles(connection, handles, table.fingerprint())
+        logger.info(f"[Database] Successfuly loaded {len(table)} deltas")
+
+    # Adds deltas from the given index on, earlier ones must already be in the database
+    def append_deltas(self, dataset: Dataset, start: int, handles: dict[str, str]):
+        table = dataset.deltas
+        logger.info(f"[Database] Appending {len(table) - start} deltas to {self.path.name}")
+        with self.__lock, metrics.span("database_append"):
+            connection = self.__connect()
+            user_ids = self.__user_ids(connection, table.users)
+            lengths = dict(connection.execute(
+                "SELECT user_id, length FROM deltas WHERE id IN (SELECT MAX(id) FROM deltas GROUP BY user_id)"
+            ).fetchall())
+            connection.execute("DELETE FROM meta WHERE key = 'fingerprint'")
+            self.__insert_deltas(connection, table, start, user_ids, lengths)
+            self.__write_handles(connection, handles, table.fingerprint())
+
+    def write_leader_segments(self, history: list[tuple[str, datetime, datetime]]):
+        with self.__lock:
+            connection = self.__connect()
+            users = sorted({entry[0] for entry in history})
+            ids = dict(zip(users, self.__user_ids(connection, users)))
+            connection.execute("BEGIN")
+            connection.execute("DELETE FROM leader_segments")
+            connection.executemany(
+                "INSERT INTO leader_segments (user_id, start_time, start_offset, end_time, end_offset) VALUES (?, ?, ?, ?, ?)",
+                ((ids[user], start.timestamp(), offset_minutes(start), end.timestamp(), offset_minutes(end)) for user, start, end in history),
+            )
+            connection.execute("COMMIT")
+
+def migrate_to_db(dataset: Dataset, best_players_history: list[tuple[str, datetime, datetime]], database: Database = None) -> Database:
+    database = database or Database()
+    if database.fingerprint() != dataset.deltas.fingerprint():
+        database.write_dataset(dataset, saved_handles())
+    else:
+        logger.info(f"[Database] Database {database.path.name} is up to date")
+    database.write_leader_segments(best_players_history)
+    return database
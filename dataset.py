@@ -1,9 +1,14 @@
-from classes import Dataset, DeltaInstance
+from classes import Dataset, DeltaInstance, DeltaTable
 from logger import logger
+from cache_folder import cache_folder, cache_path
+from metrics import metrics
 import os
 from pathlib import Path
 import datetime
-from parse_archive import parse_archive
+import struct
+import numpy as np
+from parse_archive import parse_archive_incremental, list_message_files, PARSER_VERSION
+from manifest import Manifest, load_manifest, save_manifest, fingerprint_archive, fingerprint_file
 import user_options
 import messenger
 
@@ -19,43 +24,191 @@ def __read_delta(line: str) -> DeltaInstance:
     new_length = None if new_length_str == "None" else int(new_length_str)
     return DeltaInstance(user, timestamp, delta, wait_time, is_reset, new_length)
 
+def __read_deltas_text(path: Path) -> list[DeltaInstance]:
+    with open(path, 'r') as file:
+        return [__read_delta(line) for line in file]
+
+# Binary cache layout: header, user names separated by new lines, then every column
+# stored as a raw little-endian array. Every section is aligned to 8 bytes
+__MAGIC = b"PESUNDS\0"
+__FORMAT_VERSION = 1
+__HEADER = struct.Struct("<8sIQIQ")
+__ALIGNMENT = 8
+__COLUMNS = [
+    ("timestamps", np.dtype("<i8")),
+    ("offsets", np.dtype("<i2")),
+    ("user_ids", np.dtype("<i4")),
+    ("deltas", np.dtype("<i4")),
+    ("wait_minutes", np.dtype("<i4")),
+    ("new_lengths", np.dtype("<i4")),
+    ("is_resets", np.dtype("u1")),
+]
+
+def __padding(size: int) -> int:
+    return (-size) % __ALIGNMENT
+
+# Tables read earlier are memory-mapped views of the file, so it is never written in place.
+# A new file replaces it, and mapped tables keep seeing the old one
+def __write_table(path: Path, table: DeltaTable):
+    users_blob = "\n".join(table.users).encode()
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, 'wb') as file:
+        file.write(__HEADER.pack(__MAGIC, __FORMAT_VERSION, len(table), len(table.users), len(users_blob)))
+        file.write(users_blob + b"\0" * __padding(len(users_blob)))
+        for name, dtype in __COLUMNS:
+            data = np.ascontiguousarray(getattr(table, name), dtype=dtype).tobytes()
+            file.write(data + b"\0" * __padding(len(data)))
+    os.replace(temp_path, path)
+
+def __read_table(path: Path) -> DeltaTable:
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    magic, version, count, users_count, users_size = __HEADER.unpack_from(data, 0)
+    if magic != __MAGIC or version != __FORMAT_VERSION:
+        logger.error(f"File {path.name} is not a supported dataset file")
+        return None
+    offset = __HEADER.size
+    users_blob = bytes(data[offset:offset + users_size])
+    users = users_blob.decode().split("\n") if users_count > 0 else []
+    offset += users_size + __padding(users_size)
+    arrays = []
+    for _, dtype in __COLUMNS:
+        # Columns are views into the memory-mapped file, nothing is copied here
+        arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+        size = count * dtype.itemsize
+        offset += size + __padding(size)
+    return DeltaTable(users, *arrays)
+
+def __write_deltas(path: Path, deltas: list[DeltaInstance]):
+    __write_table(path, DeltaTable.from_instances(deltas))
+
+def __read_deltas(path: Path) -> list[DeltaInstance]:
+    table = __read_table(path)
+    return None if table is None else table.to_instances()
+
+def __segment_path(file_name: str) -> Path:
+    return cache_path('segments') / f"{file_name}.bin"
+
+def __save_segment(file_name: str, deltas: list[DeltaInstance]):
+    os.makedirs(cache_path('segments'), exist_ok=True)
+    with metrics.span("cache_save", cache="segment"):
+        __write_deltas(__segment_path(file_name), deltas)
+
+def __load_segment(file_name: str) -> list[DeltaInstance]:
+    path = __segment_path(file_name)
+    if path.exists() and path.is_file():
+        with metrics.span("cache_load", cache="segment"):
+            return __read_deltas(path)
+    legacy_path = path.with_suffix(".txt")
+    if legacy_path.exists() and legacy_path.is_file():
+        deltas = __read_deltas_text(legacy_path)
+        __save_segment(file_name, deltas)
+        legacy_path.unlink()
+        return deltas
+    return None
+
+def __remove_stale_segments(manifest: Manifest):
+    folder = cache_path('segments')
+    if not folder.exists():
+        return
+    for path in folder.glob("*.*"):
+        if path.stem not in manifest.files:
+            logger.info(f"Removing stale segment {path.name}")
+            path.unlink()
+
+def __migrate_text_dataset(text_path: Path, path: Path):
+    logger.info(f"Migrating dataset file {text_path.name} to {path.name}")
+    deltas = __read_deltas_text(text_path)
+    __write_deltas(path, deltas)
+    text_path.unlink()
+    logger.info(f"Successfuly migrated {len(deltas)} deltas")
+
 def save_dataset(dataset: Dataset):
-    os.makedirs("cache", exist_ok=True)
-    path = Path('cache/dataset.txt')
-    path.touch(exist_ok=True)
+    os.makedirs(cache_folder(), exist_ok=True)
+    path = cache_path('dataset.bin')
     logger.info(f"Saving dataset to file {path.name}")
-    with open(path, 'w') as file:
-        for delta in dataset.deltas:
-            __write_delta(file, delta)
-        logger.info(f"Successfuly written {len(dataset.deltas)} deltas to a file")
+    with metrics.span("cache_save", cache="dataset"):
+        __write_table(path, dataset.deltas)
+    logger.info(f"Successfuly written {len(dataset.deltas)} deltas to a file")
+    text_path = cache_path('dataset.txt')
+    if text_path.exists():
+        logger.info(f"Removing outdated dataset file {text_path.name}")
+        text_path.unlink()
 
 def load_dataset() -> Dataset:
-    path = Path('cache/dataset.txt')
+    path = cache_path('dataset.bin')
+    text_path = cache_path('dataset.txt')
+    if not path.exists() and text_path.exists() and text_path.is_file():
+        __migrate_text_dataset(text_path, path)
     if not path.exists() or not path.is_file():
         return None
     logger.info(f"Reading dataset from file {path.name}")
-    with open(path, 'r') as file:
-        deltas = []
-        for line in file:
-            deltas.append(__read_delta(line))
-        logger.info(f"Successfuly read {len(deltas)} deltas from a file")
-        return Dataset(deltas, [])
-    
+    with metrics.span("cache_load", cache="dataset"):
+        table = __read_table(path)
+    if table is None:
+        return None
+    logger.info(f"Successfuly read {len(table)} deltas from a file")
+    return Dataset(table, [])
+
+def __parse_workers() -> int:
+    return max(1, int(os.getenv("PARSE_WORKERS", "1")))
+
+def update_dataset(archive_name: str, manifest: Manifest) -> Dataset:
+    dataset, new_manifest, parsed_segments = parse_archive_incremental(archive_name, manifest, __load_segment, __parse_workers())
+    for file_name, deltas in parsed_segments.items():
+        __save_segment(file_name, deltas)
+    __remove_stale_segments(new_manifest)
+    save_dataset(dataset)
+    save_manifest(new_manifest)
+    return dataset
+
 def exists() -> bool:
-    path = Path('cache/dataset.txt')
-    if not path.exists() or not path.is_file():
-        return False
-    return True
-    
-def get_dataset() -> Dataset:
-    if exists():
-        logger.info("Dataset file exists, getting it from there")
-        return load_dataset()
-    else:
-        logger.info("Dataset file doesn't exist, parsing")
+    for path in [cache_path('dataset.bin'), cache_path('dataset.txt')]:
+        if path.exists() and path.is_file():
+            return True
+    return False
+
+class CacheAction:
+    REUSE = "reuse"
+    UPDATE = "update"
+    REBUILD = "rebuild"
+
+def choose_cache_action(archive_name: str, manifest: Manifest) -> str:
+    archive_path = Path(archive_name)
+    if not archive_path.is_dir():
+        if exists():
+            logger.warning(f"Archive {archive_name} is not available, using cached dataset without checking it")
+            return CacheAction.REUSE
+        return CacheAction.REBUILD
+    if manifest is None or not manifest.same_archive(fingerprint_archive(archive_path, PARSER_VERSION)):
+        return CacheAction.REBUILD
+    message_files = list_message_files(archive_path)
+    if {html_file.name for html_file in message_files} != set(manifest.files.keys()):
+        return CacheAction.UPDATE
+    for html_file in message_files:
+        previous = manifest.files[html_file.name]
+        if not previous.same_content(fingerprint_file(html_file, PARSER_VERSION, previous)):
+            return CacheAction.UPDATE
+    if not exists():
+        return CacheAction.UPDATE
+    return CacheAction.REUSE
+
+def get_dataset(archive_name: str = None) -> Dataset:
+    if archive_name is None:
         archive_name = user_options.get_archive_name()
-        messenger.archive_parsing()
-        dataset = parse_archive(archive_name)
-        save_dataset(dataset)
-        messenger.archive_parsed()
-        return dataset
\ No newline at end of file
+    manifest = load_manifest()
+    action = choose_cache_action(archive_name, manifest)
+    if action == CacheAction.REUSE:
+        logger.info("Archive didn't change, getting dataset from the cache")
+        dataset = load_dataset()
+        if dataset is not None:
+            return dataset
+        action = CacheAction.REBUILD
+    if action == CacheAction.REBUILD:
+        logger.info("Cache is missing or outdated, parsing the whole archive")
+        manifest = Manifest()
+    else:
+        logger.info("Archive has changed, parsing only new or changed files")
+    messenger.archive_parsing()
+    dataset = update_dataset(archive_name, manifest)
+    messenger.archive_parsed()
+    return dataset
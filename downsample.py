@@ -0,0 +1,34 @@
+import numpy as np
+
+# Largest-Triangle-Three-Buckets: keeps the first and last points and from every bucket in between
+# the point forming the largest triangle with the previously kept point and the next bucket's average.
+# Returns indices of the kept points, so the caller can pick any columns with them
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    bucket_size = (n - 2) / (threshold - 2)
+    edges = (np.arange(threshold - 1) * bucket_size).astype(np.int64) + 1
+    edges[-1] = n - 1
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    prev = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i+1]
+        next_end = edges[i+2] if i + 2 < len(edges) else n
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+        areas = np.abs((x[prev] - average_x) * (y[start:end] - y[prev]) - (x[prev] - x[start:end]) * (average_y - y[prev]))
+        prev = start + int(np.argmax(areas))
+        indices[i+1] = prev
+    return indices
+
+# Indices of the points inside [start, end], together with one neighbour on each side,
+# so that lines leaving the visible range are still drawn
+def visible_indices(x: np.ndarray, start: float, end: float) -> np.ndarray:
+    first = max(int(np.searchsorted(x, start, side="left")) - 1, 0)
+    last = min(int(np.searchsorted(x, end, side="right")) + 1, len(x))
+    return np.arange(first, last)
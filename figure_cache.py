@@ -0,0 +1,64 @@
+from logger import logger
+from metrics import metrics
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
+import json
+import plotly.io as pio
+
+# Figures are stored as plain JSON data, so a hit skips both building the figure and validating it
+def serialize_figure(fig) -> dict:
+    return json.loads(pio.to_json(fig, validate=False))
+
+# Least recently used figures are evicted once the cache is full. Keys should include the
+# analytics version, so figures of an outdated analytics are never returned
+class FigureCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__entries: OrderedDict[tuple, object] = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key: tuple):
+        with self.__lock:
+            value = self.__entries.get(key)
+            if value is None:
+                self.misses += 1
+                metrics.increment("figure_cache_misses_total")
+                return None
+            self.hits += 1
+            metrics.increment("figure_cache_hits_total")
+            self.__entries.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value):
+        if self.max_size <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    # Building happens outside of the lock, so a slow figure doesn't block other users
+    def get_or_build(self, key: tuple, build: Callable[[], object]):
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(f"[FigureCache] size = {stats["size"]}/{stats["max_size"]} hits = {stats["hits"]} misses = {stats["misses"]}")
@@ -0,0 +1,105 @@
+from datetime import datetime
+from bisect import bisect_left, bisect_right
+
+# A continuous period of the timeline. Short periods are merged into one bar,
+# that is shown as the user who led for the most time within it
+class TimelineBar:
+    __slots__ = ("start", "end", "leader", "durations", "changes", "first_period")
+
+    def __init__(self, start: float, end: float, leader: str, durations: dict[str, float], changes: int, first_period: int):
+        self.start = start
+        self.end = end
+        self.leader = leader
+        self.durations = durations
+        self.changes = changes
+        self.first_period = first_period
+
+    @staticmethod
+    def merge(bars: list["TimelineBar"]) -> "TimelineBar":
+        durations = {}
+        for bar in bars:
+            for user, duration in bar.durations.items():
+                durations[user] = durations.get(user, 0) + duration
+        leader = max(durations.items(), key=lambda entry: entry[1])[0]
+        changes = sum(bar.changes for bar in bars) + len(bars) - 1
+        return TimelineBar(bars[0].start, bars[-1].end, leader, durations, changes, bars[0].first_period)
+
+def aggregate_bars(bars: list[TimelineBar], width: float) -> list[TimelineBar]:
+    result: list[TimelineBar] = []
+    bucket: list[TimelineBar] = []
+    def add(bar: TimelineBar):
+        # Neighbours with the same leader are shown as one bar anyway
+        if len(result) > 0 and result[-1].leader == bar.leader:
+            result[-1] = TimelineBar.merge([result[-1], bar])
+        else:
+            result.append(bar)
+    def flush():
+        if len(bucket) > 0:
+            add(bucket[0] if len(bucket) == 1 else TimelineBar.merge(bucket))
+            bucket.clear()
+    for bar in bars:
+        if bar.end - bar.start >= width:
+            flush()
+            add(bar)
+            continue
+        bucket.append(bar)
+        if bucket[-1].end - bucket[0].start >= width:
+            flush()
+    flush()
+    return result
+
+class TimelineLevel:
+    def __init__(self, width: float, bars: list[TimelineBar]):
+        self.width = width
+        self.bars = bars
+        self.starts = [bar.start for bar in bars]
+        self.ends = [bar.end for bar in bars]
+
+    def slice(self, start: float, end: float) -> list[TimelineBar]:
+        first = bisect_right(self.ends, start)
+        last = bisect_left(self.starts, end)
+        return self.bars[first:last]
+
+# Leader timeline kept at several resolutions, every level merges periods shorter than its
+# width, and widths double from level to level. A query uses the coarsest level, that still has about the
+# requested number of bars in the visible range, so the result size doesn't depend on how
+# often the leader changed
+class LeaderTimeline:
+    def __init__(self, history: list[tuple[str, datetime, datetime]], coarsest_bars: int = 8, max_levels: int = 24):
+        raw = [
+            TimelineBar(entry[1].timestamp(), entry[2].timestamp(), entry[0], {entry[0]: (entry[2] - entry[1]).total_seconds()}, 0, period)
+            for period, entry in enumerate(history, start=1)
+        ]
+        self.levels = [TimelineLevel(0, raw)]
+        if len(raw) == 0:
+            return
+        span = raw[-1].end - raw[0].start
+        shortest = min(bar.end - bar.start for bar in raw)
+        widths = []
+        width = span / coarsest_bars
+        while width > shortest and len(widths) < max_levels:
+            widths.append(width)
+            width /= 2
+        bars = raw
+        for width in reversed(widths):
+            aggregated = aggregate_bars(bars, width)
+            # Levels, that didn't merge anything, would only take memory
+            if len(aggregated) < len(bars):
+                bars = aggregated
+                self.levels.append(TimelineLevel(width, bars))
+
+    def start(self) -> float:
+        bars = self.levels[0].bars
+        return bars[0].start if len(bars) > 0 else 0
+
+    def end(self) -> float:
+        bars = self.levels[0].bars
+        return bars[-1].end if len(bars) > 0 else 0
+
+    def query(self, start: float, end: float, max_bars: int) -> list[TimelineBar]:
+        resolution = (end - start) / max(max_bars, 1)
+        level = self.levels[0]
+        for candidate in self.levels[1:]:
+            if candidate.width <= resolution:
+                level = candidate
+        return level.slice(start, end)
@@ -0,0 +1,56 @@
+from bisect import bisect_left
+
+# Users ordered by length, ties are broken by the order users first appeared in.
+# Keys are kept in a sorted list: positions are found with O(log U) binary searches, but moving
+# a key shifts the list in O(U), and users overtaken by a falling user are visited one by one.
+# Chats have a few dozen users at most, so shifting a short list is cheaper than a tree
+class Leaderboard:
+    def __init__(self):
+        self.__keys: list[tuple[int, int]] = []
+        self.__orders: dict[str, int] = {}
+        self.__users: list[str] = []
+        self.__lengths: dict[str, int] = {}
+        self.best_rank: dict[str, int] = {}
+
+    def __improve_rank(self, user: str, rank: int):
+        cur_rank = self.best_rank.get(user)
+        if cur_rank is None or rank < cur_rank:
+            self.best_rank[user] = rank
+
+    def update(self, user: str, length: int):
+        keys = self.__keys
+        order = self.__orders.get(user)
+        if order is None:
+            order = len(self.__users)
+            self.__orders[user] = order
+            self.__users.append(user)
+            old_index = None
+        else:
+            old_index = bisect_left(keys, (-self.__lengths[user], order))
+            del keys[old_index]
+        new_key = (-length, order)
+        new_index = bisect_left(keys, new_key)
+        keys.insert(new_index, new_key)
+        self.__lengths[user] = length
+        self.__improve_rank(user, new_index+1)
+        # Only users that were overtaken by a falling user move up
+        if old_index is not None and new_index > old_index:
+            for i in range(old_index, new_index):
+                self.__improve_rank(self.__users[keys[i][1]], i+1)
+
+    def leader(self) -> str:
+        if len(self.__keys) == 0:
+            return None
+        return self.__users[self.__keys[0][1]]
+
+    def rank(self, user: str) -> int:
+        order = self.__orders.get(user)
+        if order is None:
+            return None
+        return bisect_left(self.__keys, (-self.__lengths[user], order)) + 1
+
+    def length(self, user: str) -> int:
+        return self.__lengths.get(user, 0)
+
+    def __len__(self) -> int:
+        return len(self.__keys)
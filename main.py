@@ -1,25 +1,52 @@
 import messenger
 from logger import logger
-from analytics import build_analytics
-from user_options import read_options
+from analytics import Analytics
+from snapshot import get_analytics
+from user_options import read_options, set_archive_names, get_archive_names
 from dataset import get_dataset
-import plotter
 from dotenv import load_dotenv
+from classes import Dataset
+import os
 
-# EXPERIMENTAL Saves parsed data into a database
-def migrate_to_db():
-    ...
+# Saves parsed data and leader periods into the SQLite database, that ANALYTICS_BACKEND=sqlite reads from
+def migrate_to_db(dataset: Dataset, analytics: Analytics):
+    import database
+    database.migrate_to_db(dataset, analytics.get_best_players_history())
 
-def main():
+# Keeps analytics up to date with the archive while the app is running
+def watch_archive(dataset: Dataset, analytics: Analytics):
+    if int(os.getenv("WORKERS", "1")) > 1:
+        logger.warning("Watching the archive is not supported with several workers, analytics won't be updated")
+        return
+    from watcher import ArchiveWatcher
+    from user_options import get_archive_name
+    interval = float(os.getenv("WATCH_INTERVAL", "60"))
+    ArchiveWatcher(get_archive_name(), dataset, analytics, interval).start()
+
+def main(archive_names: list[str] = None):
     load_dotenv()
     messenger.notify_app_started()
     read_options()
-    dataset = get_dataset()
-    if len(dataset.unknown_users) > 0:
-        messenger.notify_unknown_users(dataset.unknown_users)
+    set_archive_names(archive_names)
+    archive_names = get_archive_names()
+    from multi_chat import Chat, analyze_chats, chat_names
+    if len(archive_names) > 1:
+        # Every chat is analyzed in its own worker with its own caches
+        chats = analyze_chats(archive_names)
+        if os.getenv("WATCH_ARCHIVE") == "TRUE":
+            logger.warning("Watching archives is only supported with one chat, analytics won't be updated")
+    else:
+        dataset = get_dataset()
+        if len(dataset.unknown_users) > 0:
+            messenger.notify_unknown_users(dataset.unknown_users)
 
-    analytics = build_analytics(dataset)
-    plotter.init(analytics)
+        analytics = get_analytics(dataset)
+        if os.getenv("WATCH_ARCHIVE") == "TRUE":
+            watch_archive(dataset, analytics)
+        chats = [Chat(chat_names(archive_names)[0], archive_names[0], analytics)]
+    # Dashboard libraries take a while to import, so they are loaded only when needed
+    import plotter
+    plotter.init(chats)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,79 @@
+from logger import logger
+from cache_folder import cache_folder, cache_path
+from pathlib import Path
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 2
+
+class FileRecord:
+    def __init__(self, size: int, mtime_ns: int, hash: str, parser_version: int, handles_before: dict[str, str] = None, handles_after: dict[str, str] = None):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.hash = hash
+        self.parser_version = parser_version
+        self.handles_before = handles_before or {}
+        self.handles_after = handles_after or {}
+
+    def same_content(self, other: "FileRecord") -> bool:
+        return self.size == other.size and self.hash == other.hash and self.parser_version == other.parser_version
+
+class Manifest:
+    def __init__(self, files: dict[str, FileRecord] = None, archive_path: str = None, nicknames_hash: str = None, parser_version: int = None):
+        self.files = files or {}
+        self.archive_path = archive_path
+        self.nicknames_hash = nicknames_hash
+        self.parser_version = parser_version
+
+    # Nicknames and parser affect every file, so any change there invalidates the whole cache
+    def same_archive(self, other: "Manifest") -> bool:
+        return self.archive_path == other.archive_path and self.nicknames_hash == other.nicknames_hash and self.parser_version == other.parser_version
+
+def __hash_file(path: Path) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def fingerprint_file(path: Path, parser_version: int, previous: FileRecord = None) -> FileRecord:
+    stat = path.stat()
+    # Size and mtime didn't change, so there is no need to read the whole file again
+    if previous is not None and previous.size == stat.st_size and previous.mtime_ns == stat.st_mtime_ns:
+        hash = previous.hash
+    else:
+        hash = __hash_file(path)
+    return FileRecord(stat.st_size, stat.st_mtime_ns, hash, parser_version)
+
+def fingerprint_archive(archive_path: Path, parser_version: int) -> Manifest:
+    nicknames_path = archive_path / "nicknames.txt"
+    nicknames_hash = __hash_file(nicknames_path) if nicknames_path.is_file() else None
+    return Manifest({}, str(archive_path.resolve()), nicknames_hash, parser_version)
+
+def load_manifest() -> Manifest:
+    path = cache_path('manifest.json')
+    if not path.exists() or not path.is_file():
+        return None
+    logger.info(f"Reading manifest from file {path.name}")
+    with open(path, 'r') as file:
+        content = json.load(file)
+    if content.get("version") != MANIFEST_VERSION:
+        logger.warning(f"Manifest version {content.get("version")} is not supported, ignoring it")
+        return None
+    files = {name: FileRecord(**record) for name, record in content["files"].items()}
+    return Manifest(files, content["archive_path"], content["nicknames_hash"], content["parser_version"])
+
+def save_manifest(manifest: Manifest):
+    os.makedirs(cache_folder(), exist_ok=True)
+    path = cache_path('manifest.json')
+    logger.info(f"Saving manifest to file {path.name}")
+    content = {
+        "version": MANIFEST_VERSION,
+        "archive_path": manifest.archive_path,
+        "nicknames_hash": manifest.nicknames_hash,
+        "parser_version": manifest.parser_version,
+        "files": {name: vars(record) for name, record in manifest.files.items()},
+    }
+    with open(path, 'w') as file:
+        json.dump(content, file, ensure_ascii=False)
@@ -0,0 +1,201 @@
+from logger import logger
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from bisect import bisect_left
+from functools import wraps
+from pathlib import Path
+from threading import Lock, Thread, Event, get_ident
+from time import perf_counter
+from typing import Callable
+import os
+import sys
+
+# Upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+class Histogram:
+    def __init__(self, buckets: list[float]):
+        self.buckets = buckets
+        # The last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def __escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def __format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{__escape_label(value)}"' for key, value in labels) + "}"
+
+def __format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def render_metric_lines(counters: dict, histograms: dict, gauges: dict) -> list[str]:
+    lines = []
+    for name in sorted({key[0] for key in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{__format_labels(labels)} {__format_value(value)}")
+    for name in sorted(gauges):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {__format_value(gauges[name])}")
+    for name in sorted({key[0] for key in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), histogram in sorted(histograms.items(), key=lambda entry: entry[0]):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + [float("inf")], histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{name}_bucket{__format_labels(labels + (("le", le),))} {cumulative}")
+            lines.append(f"{name}_sum{__format_labels(labels)} {repr(histogram.sum)}")
+            lines.append(f"{name}_count{__format_labels(labels)} {histogram.count}")
+    return lines
+
+# Counters and latency histograms of the current process, rendered in the Prometheus text format.
+# With several workers every worker has its own metrics
+class Metrics:
+    def __init__(self):
+        self.__counters: dict[tuple[str, tuple], float] = {}
+        self.__histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.__gauges: dict[str, Callable[[], float]] = {}
+        self.__lock = Lock()
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(LATENCY_BUCKETS)
+                self.__histograms[key] = histogram
+            histogram.observe(value)
+
+    # Gauges are read when the metrics are rendered
+    def gauge(self, name: str, read: Callable[[], float]):
+        with self.__lock:
+            self.__gauges[name] = read
+
+    # Times the block into the <name>_seconds histogram and counts failures in <name>_errors_total
+    @contextmanager
+    def span(self, name: str, **labels):
+        start = perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.increment(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        with self.__lock:
+            counters = dict(self.__counters)
+            histograms = {key: self.__copy_histogram(histogram) for key, histogram in self.__histograms.items()}
+            gauges = dict(self.__gauges)
+        values = {}
+        for name, read in gauges.items():
+            try:
+                values[name] = read()
+            except Exception:
+                logger.exception(f"[Metrics] Failed to read gauge {name}")
+        return "\n".join(render_metric_lines(counters, histograms, values)) + "\n"
+
+    def reset(self):
+        with self.__lock:
+            self.__counters.clear()
+            self.__histograms.clear()
+
+    @staticmethod
+    def __copy_histogram(histogram: Histogram) -> Histogram:
+        copy = Histogram(histogram.buckets)
+        copy.counts = list(histogram.counts)
+        copy.sum = histogram.sum
+        copy.count = histogram.count
+        return copy
+
+metrics = Metrics()
+
+def collapsed_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+# Samples the stack of one thread while it runs a callback. Stacks are kept in the collapsed format,
+# one "frame;frame;frame count" line per stack, that flame graph tools read
+class SamplingProfiler:
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self.__stopped = Event()
+        self.__thread: Thread = None
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapsed_stack(frame)] += 1
+
+    def start(self):
+        self.__thread = Thread(target=self.__run, name="callback-profiler", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+
+    def dump(self, path: Path):
+        os.makedirs(path.parent, exist_ok=True)
+        with open(path, 'w') as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+def __slow_callback_threshold() -> float:
+    value = os.getenv("PROFILE_SLOW_CALLBACKS_MS")
+    return float(value) / 1000 if value else None
+
+# Wraps a Dash callback to count its calls and time them. When PROFILE_SLOW_CALLBACKS_MS is set,
+# every call is sampled, and the stacks of calls slower than that are saved to logs/profiles
+def instrument_callback(name: str):
+    threshold = __slow_callback_threshold()
+    interval = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+    def decorator(callback: Callable) -> Callable:
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            metrics.increment("dash_callback_calls_total", callback=name)
+            profiler = None
+            if threshold is not None:
+                profiler = SamplingProfiler(get_ident(), interval)
+                profiler.start()
+            start = perf_counter()
+            try:
+                with metrics.span("dash_callback", callback=name):
+                    return callback(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    profiler.stop()
+                    duration = perf_counter() - start
+                    if duration >= threshold:
+                        path = Path("logs/profiles") / f"{datetime.now():%d.%m.%y_%H:%M:%S.%f}_{name}.txt"
+                        profiler.dump(path)
+                        logger.info(f"[Metrics] Callback {name} took {duration:.3f}s, saved {profiler.samples.total()} samples to {path}")
+        return wrapper
+    return decorator
@@ -0,0 +1,95 @@
+from analytics import Analytics
+from cache_folder import cache_folder, chat_cache_folder, set_cache_folder
+from logger import logger
+from metrics import metrics
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+import os
+
+class Chat:
+    def __init__(self, name: str, archive_name: str, analytics: Analytics):
+        self.name = name
+        self.archive_name = archive_name
+        self.analytics = analytics
+
+# Chats are named after their archive folders, same names get a number
+def chat_names(archive_names: list[str]) -> list[str]:
+    names = []
+    for archive_name in archive_names:
+        name = Path(archive_name).resolve().name
+        unique_name = name
+        number = 2
+        while unique_name in names:
+            unique_name = f"{name} ({number})"
+            number += 1
+        names.append(unique_name)
+    return names
+
+# Parses and analyzes one chat with caches in its own folder. Runs in a worker process,
+# analytics are sent back to the main process the same way snapshots are saved
+def analyze_chat(archive_name: str) -> tuple[Analytics, set[str]]:
+    from dataset import get_dataset
+    from snapshot import get_analytics
+    set_cache_folder(chat_cache_folder(archive_name))
+    logger.info(f"[Chats] Analyzing chat {archive_name} with caches in {cache_folder()}")
+    with metrics.span("chat_analysis"):
+        dataset = get_dataset(archive_name)
+        return get_analytics(dataset), dataset.unknown_users
+
+def __chat_workers(count: int) -> int:
+    workers = os.getenv("CHAT_WORKERS") or str(os.cpu_count() or 1)
+    return max(1, min(count, int(workers)))
+
+def analyze_chats(archive_names: list[str]) -> list[Chat]:
+    import messenger
+    workers = __chat_workers(len(archive_names))
+    logger.info(f"[Chats] Analyzing {len(archive_names)} chats with {workers} workers")
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(analyze_chat, archive_names))
+    else:
+        folder = cache_folder()
+        results = [analyze_chat(archive_name) for archive_name in archive_names]
+        set_cache_folder(folder)
+    chats = []
+    for name, archive_name, (analytics, unknown_users) in zip(chat_names(archive_names), archive_names, results):
+        if len(unknown_users) > 0:
+            messenger.notify_unknown_users(unknown_users)
+        chats.append(Chat(name, archive_name, analytics))
+    return chats
+
+# Statistics of one user summed over every chat the user plays in
+class UserTotals:
+    def __init__(self, user: str):
+        self.user = user
+        self.length = 0
+        self.events_count = 0
+        self.best_rank: int = None
+        self.leader_duration = timedelta()
+        self.chat_lengths: dict[str, int] = {}
+
+# Users are matched between chats by their names, so nicknames.txt of every archive
+# should map handles to the same names
+class CrossChatAnalytics:
+    def __init__(self, chats: list[Chat]):
+        self.chats = [chat.name for chat in chats]
+        self.totals: dict[str, UserTotals] = {}
+        for chat in chats:
+            analytics = chat.analytics
+            with analytics.lock:
+                durations = analytics.get_user_domination_durations()
+                for user, summary in analytics.get_user_summaries().items():
+                    totals = self.totals.get(user)
+                    if totals is None:
+                        totals = UserTotals(user)
+                        self.totals[user] = totals
+                    totals.length += summary.length
+                    totals.events_count += summary.events_count
+                    totals.best_rank = summary.best_rank if totals.best_rank is None else min(totals.best_rank, summary.best_rank)
+                    totals.leader_duration += durations.get(user, timedelta())
+                    totals.chat_lengths[chat.name] = summary.length
+
+    # Users by their total length over all chats
+    def leaderboard(self) -> list[UserTotals]:
+        return sorted(self.totals.values(), key=lambda totals: (-totals.length, totals.user))
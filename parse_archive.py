@@ -1,10 +1,43 @@
 from logger import logger
-from classes import DeltaInstance, Dataset
+from metrics import metrics
+from classes import DeltaInstance, DeltaTable, Dataset
+from manifest import Manifest, FileRecord, fingerprint_file, fingerprint_archive
 from pathlib import Path
-from bs4 import BeautifulSoup
-from datetime import datetime
+from typing import Callable, Iterator
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import heapq
+import html
+import json
+import os
 import re
 
+# Bump whenever parsing results change, so that cached files get parsed again
+PARSER_VERSION = 1
+
+class PendingUser(str):
+    pass
+
+# Files parsed in parallel don't know handles saved by the earlier files, so lookups
+# of such handles are deferred to a resolution pass, that runs over files in order
+class DetachedHandles(dict):
+    def get(self, handle, default=None):
+        if handle in self:
+            return self[handle]
+        return PendingUser(handle)
+
+class RawMessage:
+    __slots__ = ("id", "joined", "from_name", "title", "reply_to", "text")
+
+    def __init__(self, id: int, joined: bool, from_name: str, title: str, reply_to: int, text: str):
+        self.id = id
+        self.joined = joined
+        self.from_name = from_name
+        self.title = title
+        self.reply_to = reply_to
+        self.text = text
+
 class MessageMeta:
     def __init__(self, from_user: str, id: int):
         self.from_user = from_user
@@ -42,61 +75,71 @@ def __parse_response_id(message: str) -> int:
     id_search = re.search(r'GoToMessage\((\d+)\)', message, flags=re.DOTALL)
     id = int(id_search.group(1).strip()) if id_search else None
     return id
-    
-def __parse_timestamp(message: str) -> datetime:
-    timestamp_search = re.search(r'title="([^"]+)"', message)
-    if not timestamp_search:
-        return None
-    timestamp_str = timestamp_search.group(1)
-    if not timestamp_str:
+
+def __parse_title(message: str) -> str:
+    title_search = re.search(r'title="([^"]+)"', message)
+    return title_search.group(1) if title_search else None
+
+def __parse_text(message: str) -> str:
+    text_match = re.search(r'<div class="text">([.\s\S]*?)<\/div>', message, flags=re.DOTALL)
+    return text_match.group(1) if text_match else None
+
+__TITLE_PATTERN = re.compile(r'(\d\d)\.(\d\d)\.(\d{4}) (\d\d):(\d\d):(\d\d) UTC([+-])(\d\d):(\d\d)')
+__timezones: dict[str, timezone] = {}
+
+def __parse_timestamp(title: str) -> datetime:
+    if not title:
         return None
-    timestamp_str = timestamp_str.replace("UTC", "")
+    title_match = __TITLE_PATTERN.fullmatch(title)
+    if title_match:
+        day, month, year, hour, minute, second, sign, offset_hours, offset_minutes = title_match.groups()
+        offset = sign + offset_hours + offset_minutes
+        tz = __timezones.get(offset)
+        if tz is None:
+            sign_value = -1 if sign == "-" else 1
+            tz = timezone(sign_value * timedelta(hours=int(offset_hours), minutes=int(offset_minutes)))
+            __timezones[offset] = tz
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), tzinfo=tz)
+    timestamp_str = title.replace("UTC", "")
     timestamp = datetime.strptime(timestamp_str, "%d.%m.%Y %H:%M:%S %z")
     return timestamp
 
-def __parse_length_change(message: str) -> tuple[int, bool, int]:
+__LENGTH_CHANGE_PATTERN = re.compile(r'виріс на (\d+)|скоротився на (\d+)|(в тебе немає песюна)')
+
+def __parse_length_change(text: str) -> tuple[int, bool, int]:
     length_change = None
-    grow = re.search(r'виріс на (\d+)', message)
-    shrink = re.search(r'скоротився на (\d+)', message)
-    reset = re.search(r'в тебе немає песюна', message)
-    new_length_search = re.search(r'Тепер його довжина: (\d+)', message)
+    grow = re.search(r'виріс на (\d+)', text)
+    shrink = re.search(r'скоротився на (\d+)', text)
+    reset = re.search(r'в тебе немає песюна', text)
+    new_length_search = re.search(r'Тепер його довжина: (\d+)', text)
     new_length = int(new_length_search.group(1)) if new_length_search else None
     length_change = (int(grow.group(1)), False) if grow else ((-int(shrink.group(1)), False) if shrink else ((0, True) if reset else None))
     return None if length_change is None else length_change + (new_length,)
 
-def __parse_wait_minutes(message: str) -> int:
-    wait_search = re.search(r'Продовжуй грати через (\d+) год., (\d+) хв.', message)
+def __parse_wait_minutes(text: str) -> int:
+    wait_search = re.search(r'Продовжуй грати через (\d+) год., (\d+) хв.', text)
     hour = wait_search.group(1)
     minute = wait_search.group(2)
     return int(hour) * 60 + int(minute)
 
-def __parse_message_meta(message: str) -> MessageMeta:
-    id = __parse_message_id(message)
-    if id is None:
-        return None
-    from_user = __parse_from_user(message)
-    return MessageMeta(from_user, id)
-
-def __parse_handle(message: str):
+def __parse_handle(text: str):
     user = None
-    text_match = re.search(r'<div class="text">([.\s\S]*?)<\/div>', message, flags=re.DOTALL)
-    if not text_match:
+    if text is None:
         return None
-    text_content = text_match.group(1)
-    user_search = re.search(r'<a[^>]*>\s*@([^<\n]+)\s*<\/a>', text_content, flags=re.DOTALL)
+    user_search = re.search(r'<a[^>]*>\s*@([^<\n]+)\s*<\/a>', text, flags=re.DOTALL)
     # User handle provided
     if user_search:
-        nickname = '@' + user_search.group(1)
+        nickname = '@' + user_search.group(1).rstrip()
         return nickname
     # No handle, user name has been provided directly
     else:
-        name_match = re.search(r'<div class="text">\s*([^<>,]+),\s*твій песюн', message)
+        name_match = re.match(r'\s*([^<>,]+),\s*твій песюн', text)
         user = name_match.group(1).strip() if name_match else None
     return user
 
-def __parse_user(message: str, messages_meta: dict[str, MessageMeta], username_overrides: dict[str, str], saved_handles: dict[str, str]) -> str:
-    id = __parse_response_id(message)
-    handle = __parse_handle(message)
+def __parse_user(message: RawMessage, messages_meta: dict[str, MessageMeta], username_overrides: dict[str, str], saved_handles: dict[str, str]) -> str:
+    id = message.reply_to
+    handle = __parse_handle(message.text)
     if id is None or id not in messages_meta:
         logger.warning("Original message was not found. Resorting to a backup")
         return saved_handles.get(handle) if handle is not None else None
@@ -110,7 +153,7 @@ def __parse_user(message: str, messages_meta: dict[str, MessageMeta], username_o
             break
         id -= 1
     if user is None:
-        logger.warning(f"Message has no user?? id = {__parse_message_id(message)} response_id = {__parse_response_id(message)}")
+        logger.warning(f"Message has no user?? id = {message.id} response_id = {message.reply_to}")
         return None
     user = user.split()[0].strip()
     user = username_overrides[user] if user in username_overrides else user
@@ -118,14 +161,12 @@ def __parse_user(message: str, messages_meta: dict[str, MessageMeta], username_o
         saved_handles[handle] = user
     return user
 
-def __parse_message(message: str, messages_meta: dict[str, MessageMeta], username_overrides: dict[str, str], saved_handles: dict[str, str]) -> DeltaInstance:
-    id = __parse_message_id(message)
-    joined = re.search(r'message default clearfix joined', message)
+def __parse_message(message: RawMessage, messages_meta: dict[str, MessageMeta], username_overrides: dict[str, str], saved_handles: dict[str, str]) -> DeltaInstance:
     from_user = None
-    if not joined:
-        from_user = __parse_from_user(message)
+    if not message.joined:
+        from_user = message.from_name
     else:
-        parent_id = id-1
+        parent_id = message.id-1
         while True:
             parent = messages_meta.get(parent_id)
             if not parent:
@@ -136,10 +177,12 @@ def __parse_message(message: str, messages_meta: dict[str, MessageMeta], usernam
             parent_id -= 1
     if from_user != 'Ebobot':
         return None
-    timestamp = __parse_timestamp(message)
+    timestamp = __parse_timestamp(message.title)
     if timestamp is None:
         return None
-    length_change = __parse_length_change(message)
+    if message.text is None:
+        return None
+    length_change = __parse_length_change(message.text)
     if length_change is None:
         return None
     delta,is_reset,new_length = length_change
@@ -147,23 +190,246 @@ def __parse_message(message: str, messages_meta: dict[str, MessageMeta], usernam
     user = __parse_user(message, messages_meta, username_overrides, saved_handles)
     if user is None:
         return None
-    wait_minutes = __parse_wait_minutes(message)
+    wait_minutes = __parse_wait_minutes(message.text)
     return DeltaInstance(user, timestamp, delta, wait_minutes, is_reset, new_length)
 
-def __parse_html(file_path: Path, username_overrides: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
-    logger.info(f"Parsing file {file_path.name}")
+def __parse_messages(messages: list[RawMessage], messages_meta: dict[str, MessageMeta], username_overrides: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
+    parsed_messages = map(lambda message : __parse_message(message, messages_meta, username_overrides, saved_handles), messages)
+    return list(filter(lambda delta : delta is not None, parsed_messages))
+
+def __raw_message_from_block(block: str) -> RawMessage:
+    id = __parse_message_id(block)
+    joined = re.search(r'message default clearfix joined', block) is not None
+    return RawMessage(id, joined, __parse_from_user(block), __parse_title(block), __parse_response_id(block), __parse_text(block))
+
+def __parse_html_soup(file_path: Path, username_overrides: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
+    from bs4 import BeautifulSoup
     with open(file_path, 'r') as file:
         content = file.read()
         soup = BeautifulSoup(content, "html.parser")
         regular_blocks = list(map(lambda block : block.prettify(), soup.find_all("div", class_="message default clearfix")))
         joined_blocks = list(map(lambda block : block.prettify(), soup.find_all("div", class_="message default clearfix joined")))
         blocks = regular_blocks + joined_blocks
-        messages_meta_list = list(map(__parse_message_meta, blocks))
-        messages_meta = {meta.id: meta for meta in messages_meta_list}
-        parsed_messages = list(map(lambda body_block : __parse_message(body_block, messages_meta, username_overrides, saved_handles), blocks))
-        result = list(filter(lambda delta : delta is not None, parsed_messages))
+        messages = list(map(__raw_message_from_block, blocks))
+        messages_meta = {message.id: MessageMeta(message.from_name, message.id) for message in messages}
+        return __parse_messages(messages, messages_meta, username_overrides, saved_handles)
+
+__MESSAGE_START_PATTERN = re.compile(r'<div class="message ([^"]*)" id="message(-?\d+)"')
+__MESSAGE_FIELDS_PATTERN = re.compile(r'title="(?P<title>[^"]+)"|<div class="from_name">\s*(?P<from_name>.*?)\s*</div>|GoToMessage\((?P<reply_to>\d+)\)|<div class="text">(?P<text>.*?)</div>', flags=re.DOTALL)
+__ENTITY_PATTERN = re.compile(r'&(#\d+|#[xX][0-9a-fA-F]+|\w+);')
+__LEXER_CHUNK_SIZE = 1 << 20
+__LEXER_TAIL_SIZE = 256
+
+def __normalize_entities(value: str) -> str:
+    # BeautifulSoup decodes entities and encodes back only &, < and >, so we do the same
+    if value is None or '&' not in value:
+        return value
+    return __ENTITY_PATTERN.sub(lambda entity: html.escape(html.unescape(entity.group(0)), quote=False), value)
+
+def __iter_message_blocks(file) -> Iterator[tuple[str, int, str]]:
+    buffer = ""
+    while True:
+        chunk = file.read(__LEXER_CHUNK_SIZE)
+        buffer += chunk
+        starts = list(__MESSAGE_START_PATTERN.finditer(buffer))
+        # The last block might continue in the next chunk, so it is kept until the end of the file
+        complete = len(starts) if not chunk else len(starts)-1
+        for i in range(max(complete, 0)):
+            start = starts[i]
+            end = starts[i+1].start() if i+1 < len(starts) else len(buffer)
+            yield start.group(1), int(start.group(2)), buffer[start.end():end]
+        if not chunk:
+            return
+        buffer = buffer[starts[-1].start():] if starts else buffer[-__LEXER_TAIL_SIZE:]
+
+def __lex_message(classes: str, id: int, block: str) -> RawMessage:
+    fields = {}
+    for field_match in __MESSAGE_FIELDS_PATTERN.finditer(block):
+        name = field_match.lastgroup
+        if name not in fields:
+            fields[name] = field_match.group(name)
+            if len(fields) == 4:
+                break
+    reply_to = fields.get("reply_to")
+    return RawMessage(
+        id,
+        classes == "default clearfix joined",
+        __normalize_entities(fields.get("from_name")),
+        fields.get("title"),
+        int(reply_to) if reply_to is not None else None,
+        __normalize_entities(fields.get("text")),
+    )
+
+def __parse_html_lexer(file_path: Path, username_overrides: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
+    regular_messages = []
+    joined_messages = []
+    messages_meta = {}
+    with open(file_path, 'r') as file:
+        for classes, id, block in __iter_message_blocks(file):
+            if classes != "default clearfix" and classes != "default clearfix joined":
+                continue
+            message = __lex_message(classes, id, block)
+            messages_meta[id] = MessageMeta(message.from_name, id)
+            # Only messages that change length can produce a delta, the rest are needed only as metadata
+            if message.text is None or not __LENGTH_CHANGE_PATTERN.search(message.text):
+                continue
+            if message.joined:
+                joined_messages.append(message)
+            else:
+                regular_messages.append(message)
+    # Regular messages go first, same as in soup mode, so that handles are saved in the same order
+    return __parse_messages(regular_messages + joined_messages, messages_meta, username_overrides, saved_handles)
+
+JSON_EXPORT_NAME = "result.json"
+__JSON_MESSAGES_PATTERN = re.compile(r'"messages"\s*:\s*\[')
+__JSON_SEPARATOR_PATTERN = re.compile(r'[\s,]*')
+# Every message of the export starts with its id, nested objects like text entities don't have one
+__JSON_MESSAGE_START_PATTERN = re.compile(r'\{\s*"id"\s*:')
+# Longest piece of JSON, that can't be decoded until it is complete: an escaped surrogate pair
+__JSON_ESCAPE_SIZE = 12
+__JSON_MENTIONS = {"mention", "mention_name", "text_mention"}
+__json_decoder = json.JSONDecoder()
+
+# Decoding stopped because the buffer ended in the middle of the message, not because it is malformed
+def __json_truncated(error: json.JSONDecodeError, buffer: str) -> bool:
+    return error.pos >= len(buffer) - __JSON_ESCAPE_SIZE or error.msg.startswith("Unterminated string")
+
+# Messages are decoded one by one from a buffer, that is refilled from the file, so only
+# the message being decoded and the rest of the current chunk are kept in memory. A malformed
+# message is skipped up to the start of the next one
+def __iter_json_messages(file) -> Iterator[dict]:
+    buffer = ""
+    position = None
+    skipping = False
+    ended = False
+    while True:
+        if not ended:
+            chunk = file.read(__LEXER_CHUNK_SIZE)
+            ended = not chunk
+            buffer += chunk
+        if position is None:
+            start = __JSON_MESSAGES_PATTERN.search(buffer)
+            if start is None:
+                if ended:
+                    logger.error("Export doesn't have a list of messages")
+                    return
+                # Keys before the messages are short, but the key itself might be split between chunks
+                buffer = buffer[-__LEXER_TAIL_SIZE:]
+                continue
+            position = start.end()
+        if skipping:
+            start = __JSON_MESSAGE_START_PATTERN.search(buffer, position)
+            if start is None:
+                if ended:
+                    logger.error("Export ends in the middle of a message")
+                    return
+                # The start of the next message might be split between chunks
+                buffer = buffer[-__LEXER_TAIL_SIZE:]
+                position = 0
+                continue
+            position = start.start()
+            skipping = False
+        while True:
+            position = __JSON_SEPARATOR_PATTERN.match(buffer, position).end()
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                message, position = __json_decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as error:
+                if __json_truncated(error, buffer):
+                    if not ended:
+                        break
+                    logger.error("Export ends in the middle of a message")
+                    return
+                logger.error(f"Skipping a malformed message of the export: {error.msg}")
+                metrics.increment("parse_json_errors_total")
+                skipping = True
+                position += 1
+                break
+            yield message
+        buffer = buffer[position:]
+        position = 0
+
+# Text is rendered the way the HTML export shows it, so that the same patterns find handles in it
+def __json_text(message: dict) -> str:
+    parts = message.get("text_entities")
+    if parts is None:
+        text = message.get("text", "")
+        parts = [{"type": "plain", "text": text}] if isinstance(text, str) else [{"type": "plain", "text": part} if isinstance(part, str) else part for part in text]
+    result = []
+    for part in parts:
+        text = html.escape(part.get("text", ""), quote=False).replace("\n", "<br>")
+        if part.get("type") in __JSON_MENTIONS:
+            text = f'<a href="">{text}</a>'
+        result.append(text)
+    return "".join(result)
+
+# Dates are local times of the exporter without an offset, the offset is found from the unix time next to them
+def __json_title(message: dict) -> str:
+    local = datetime.fromisoformat(message["date"])
+    unixtime = message.get("date_unixtime")
+    if unixtime is None:
+        date = local.astimezone()
+    else:
+        offset = local - datetime.fromtimestamp(int(unixtime), timezone.utc).replace(tzinfo=None)
+        date = local.replace(tzinfo=timezone(offset))
+    offset_minutes = int(date.utcoffset().total_seconds() // 60)
+    sign = "-" if offset_minutes < 0 else "+"
+    return date.strftime("%d.%m.%Y %H:%M:%S") + f" UTC{sign}{abs(offset_minutes) // 60:02d}:{abs(offset_minutes) % 60:02d}"
+
+def __parse_json(file_path: Path, username_overrides: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
+    messages = []
+    messages_meta = {}
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for entry in __iter_json_messages(file):
+            # Service messages are not shown as regular messages in the HTML export either
+            if entry.get("type") != "message":
+                continue
+            id = entry["id"]
+            from_name = entry.get("from")
+            from_name = html.escape(from_name, quote=False) if from_name is not None else None
+            messages_meta[id] = MessageMeta(from_name, id)
+            if from_name != 'Ebobot':
+                continue
+            text = __json_text(entry)
+            if not __LENGTH_CHANGE_PATTERN.search(text):
+                continue
+            messages.append(RawMessage(id, False, from_name, __json_title(entry), entry.get("reply_to_message_id"), text))
+    return __parse_messages(messages, messages_meta, username_overrides, saved_handles)
+
+def __describe_delta(delta: DeltaInstance) -> tuple:
+    return (str(delta.user), delta.timestamp, delta.delta, delta.wait_minutes, delta.is_reset, delta.new_length)
+
+def __parse_html_validate(file_path: Path, username_overrides: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
+    lexer_handles = type(saved_handles)(saved_handles)
+    lexer_result = __parse_html_lexer(file_path, username_overrides, lexer_handles)
+    result = __parse_html_soup(file_path, username_overrides, saved_handles)
+    if list(map(__describe_delta, lexer_result)) != list(map(__describe_delta, result)) or lexer_handles != saved_handles:
+        logger.warning(f"Lexer and soup parsing results don't match for file {file_path.name}")
+    return result
+
+def __parse_mode() -> str:
+    return os.getenv("PARSE_MODE", "lexer").lower()
+
+def __parse_html(file_path: Path, username_overrides: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
+    logger.info(f"Parsing file {file_path.name}")
+    mode = __parse_mode()
+    if mode == "soup":
+        result = __parse_html_soup(file_path, username_overrides, saved_handles)
+    elif mode == "validate":
+        result = __parse_html_validate(file_path, username_overrides, saved_handles)
+    else:
+        result = __parse_html_lexer(file_path, username_overrides, saved_handles)
+    logger.info(f"Successfully parsed {len(result)} blocks")
+    return result
+
+def __parse_file(file_path: Path, username_overrides: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
+    if file_path.name == JSON_EXPORT_NAME:
+        logger.info(f"Parsing file {file_path.name}")
+        result = __parse_json(file_path, username_overrides, saved_handles)
         logger.info(f"Successfully parsed {len(result)} blocks")
         return result
+    return __parse_html(file_path, username_overrides, saved_handles)
 
 def __get_file_id(file: Path) -> int:
     id_search = re.search(r'messages(\d+).html', file.name)
@@ -171,7 +437,48 @@ def __get_file_id(file: Path) -> int:
         return 1
     return int(id_search.group(1))
 
-def parse_archive(path) -> Dataset:
+# The JSON export is cheaper to parse, so it is used instead of HTML files when the archive has both
+def list_message_files(archive_path: Path) -> list[Path]:
+    json_path = archive_path / JSON_EXPORT_NAME
+    if json_path.is_file():
+        return [json_path]
+    return list(sorted(archive_path.glob("messages*.html"), key = __get_file_id))
+
+def __parse_html_detached(file_path: Path, username_overrides: dict[str, str]) -> tuple[list[DeltaInstance], dict[str, str]]:
+    saved_handles = DetachedHandles()
+    deltas = __parse_file(file_path, username_overrides, saved_handles)
+    return deltas, dict(saved_handles)
+
+def __resolve_detached(deltas: list[DeltaInstance], local_handles: dict[str, str], saved_handles: dict[str, str]) -> list[DeltaInstance]:
+    result = []
+    for delta in deltas:
+        if isinstance(delta.user, PendingUser):
+            user = saved_handles.get(str(delta.user))
+            if user is None:
+                continue
+            delta.user = user
+        result.append(delta)
+    saved_handles.update(local_handles)
+    return result
+
+def __parse_files_detached(files: list[Path], username_overrides: dict[str, str], workers: int) -> dict[str, tuple[list[DeltaInstance], dict[str, str]]]:
+    if len(files) == 0:
+        return {}
+    logger.info(f"Parsing {len(files)} files with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(__parse_html_detached, files, repeat(username_overrides))
+        return {file.name: result for file, result in zip(files, results)}
+
+def __can_reuse(previous: FileRecord, record: FileRecord) -> bool:
+    return previous is not None and previous.same_content(record)
+
+def __merge_segments(segments: list[list[DeltaInstance]]) -> list[DeltaInstance]:
+    # Every segment is sorted on its own, ties are resolved in the order of segments,
+    # same as the stable sort of the serial path does
+    sorted_segments = [sorted(segment, key=lambda delta: delta.timestamp) for segment in segments]
+    return list(heapq.merge(*sorted_segments, key=lambda delta: delta.timestamp))
+
+def parse_archive_incremental(path, manifest: Manifest, load_segment: Callable[[str], list[DeltaInstance]], workers: int = 1) -> tuple[Dataset, Manifest, dict[str, list[DeltaInstance]]]:
     file = Path(path)
 
     if not file.exists():
@@ -180,13 +487,59 @@ def parse_archive(path) -> Dataset:
         logger.error("File is not a folder")
 
     logger.info("Reading archive contents")
+    new_manifest = fingerprint_archive(file, PARSER_VERSION)
+    if not manifest.same_archive(new_manifest):
+        logger.info("Archive, nicknames or parser have changed, parsing all files")
+        manifest = Manifest()
     username_overrides = __parse_username_overrides(file)
-    message_files = list(sorted(file.glob("messages*.html"), key = __get_file_id))
+    message_files = list_message_files(file)
 
     logger.info(f"Found {len(message_files)} files")
-    deltas: list[DeltaInstance] = []
+    records = {html_file.name: fingerprint_file(html_file, PARSER_VERSION, manifest.files.get(html_file.name)) for html_file in message_files}
+    detached = {}
+    if workers > 1:
+        changed_files = [html_file for html_file in message_files if not __can_reuse(manifest.files.get(html_file.name), records[html_file.name])]
+        with metrics.span("parse_files_parallel"):
+            detached = __parse_files_detached(changed_files, username_overrides, workers)
+
+    segments: list[list[DeltaInstance]] = []
+    parsed_segments: dict[str, list[DeltaInstance]] = {}
     saved_handles = {}
     for html_file in message_files:
-        deltas.extend(__parse_html(html_file, username_overrides, saved_handles))
-    deltas.sort(key=lambda delta: delta.timestamp)
-    return Dataset(deltas, set())
+        previous = manifest.files.get(html_file.name)
+        record = records[html_file.name]
+        record.handles_before = dict(saved_handles)
+        segment = None
+        # Handles resolved in earlier files affect this one, so they must match too
+        if __can_reuse(previous, record) and previous.handles_before == saved_handles:
+            segment = load_segment(html_file.name)
+        if segment is not None:
+            logger.info(f"File {html_file.name} didn't change, reusing {len(segment)} parsed deltas")
+            metrics.increment("parse_files_total", result="reused")
+            saved_handles = dict(previous.handles_after)
+        elif workers > 1:
+            if html_file.name not in detached:
+                detached[html_file.name] = __parse_html_detached(html_file, username_overrides)
+            deltas, local_handles = detached.pop(html_file.name)
+            segment = __resolve_detached(deltas, local_handles, saved_handles)
+            parsed_segments[html_file.name] = segment
+            metrics.increment("parse_files_total", result="parsed")
+        else:
+            with metrics.span("parse_file"):
+                segment = __parse_file(html_file, username_overrides, saved_handles)
+            parsed_segments[html_file.name] = segment
+            metrics.increment("parse_files_total", result="parsed")
+        record.handles_after = dict(saved_handles)
+        new_manifest.files[html_file.name] = record
+        segments.append(segment)
+    logger.info(f"Parsed {len(parsed_segments)} out of {len(message_files)} files")
+    if workers > 1:
+        deltas = __merge_segments(segments)
+    else:
+        deltas = [delta for segment in segments for delta in segment]
+        deltas.sort(key=lambda delta: delta.timestamp)
+    return Dataset(DeltaTable.from_instances(deltas), set()), new_manifest, parsed_segments
+
+def parse_archive(path, workers: int = 1) -> Dataset:
+    dataset, _, _ = parse_archive_incremental(path, Manifest(), lambda name: None, workers)
+    return dataset
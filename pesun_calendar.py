@@ -0,0 +1,91 @@
+from datetime import datetime, timezone, timedelta
+from bisect import bisect_right
+from logger import logger
+import pytz
+import numpy as np
+
+# A pesun day ends at a fixed hour of Kyiv time, which depends on whether the date is before
+# the legacy cutoff and on daylight saving time. Within one section (legacy flag and DST state)
+# it is a fixed hour of UTC time, so a day is identified by the epoch second it ends at
+LEGACY_CUTOFF = datetime(day=28, month=11, year=2022, tzinfo=timezone.utc)
+TIMEZONE = pytz.timezone("Europe/Kyiv")
+DAY = 24 * 60 * 60
+HOUR = 60 * 60
+
+class PesunCalendar:
+    @staticmethod
+    def __section(timestamp: float) -> tuple[int, int]:
+        date = datetime.fromtimestamp(timestamp, timezone.utc)
+        date_tz = date.astimezone(TIMEZONE)
+        dts = int(round(date_tz.dst().total_seconds() / HOUR))
+        offset = int(date_tz.utcoffset().total_seconds())
+        shift = 23 if date < LEGACY_CUTOFF else 2
+        target = (dts*2 + shift)%24
+        # Second of a UTC day, when the day ends in this section
+        boundary = (target * HOUR - offset) % DAY
+        return boundary, offset
+
+    def __init__(self, start_year: int, end_year: int):
+        self.start = int(datetime(start_year, 1, 1, tzinfo=timezone.utc).timestamp())
+        self.end = int(datetime(end_year, 1, 1, tzinfo=timezone.utc).timestamp())
+        self.__times: list[int] = [self.start]
+        self.__sections: list[tuple[int, int]] = [self.__section(self.start)]
+        self.__build()
+
+    def __add_transition(self, low: int, high: int):
+        # Section changes somewhere in (low, high], find the exact second
+        section = self.__section(high)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.__section(middle) == section:
+                high = middle
+            else:
+                low = middle
+        self.__times.append(high)
+        self.__sections.append(section)
+
+    def __build(self):
+        prev = self.start
+        timestamp = self.start + DAY
+        while timestamp <= self.end:
+            if self.__section(timestamp) != self.__sections[-1]:
+                self.__add_transition(prev, timestamp)
+            prev = timestamp
+            timestamp += DAY
+        logger.info(f"Built pesun calendar with {len(self.__times)} sections")
+
+    def section(self, timestamp: float) -> tuple[int, int]:
+        if timestamp < self.start or timestamp >= self.end:
+            return self.__section(timestamp)
+        return self.__sections[bisect_right(self.__times, timestamp) - 1]
+
+    # Epoch second, at which the pesun day containing the timestamp ends
+    def day_end(self, timestamp: float) -> int:
+        boundary, _ = self.section(timestamp)
+        return int((timestamp - boundary) // DAY + 1) * DAY + boundary
+
+    def next_day_end(self, day_end: int) -> int:
+        return self.day_end(day_end)
+
+    def day_ends(self, timestamps):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        times = np.array(self.__times, dtype=np.int64)
+        boundaries = np.array([section[0] for section in self.__sections], dtype=np.int64)
+        section_boundaries = boundaries[np.maximum(np.searchsorted(times, timestamps, side="right") - 1, 0)]
+        outside = (timestamps < self.start) | (timestamps >= self.end)
+        if outside.any():
+            section_boundaries[outside] = [self.__section(int(timestamp))[0] for timestamp in timestamps[outside]]
+        return ((timestamps - section_boundaries) // DAY + 1) * DAY + section_boundaries
+
+    def next_pesun_date(self, date: datetime) -> datetime:
+        timestamp = date.timestamp()
+        _, offset = self.section(timestamp)
+        return datetime.fromtimestamp(self.day_end(timestamp), timezone(timedelta(seconds=offset)))
+
+__calendar: PesunCalendar = None
+
+def get_calendar() -> PesunCalendar:
+    global __calendar
+    if __calendar is None:
+        __calendar = PesunCalendar(2015, datetime.now(timezone.utc).year + 10)
+    return __calendar
@@ -1,11 +1,21 @@
 from analytics import Analytics
+from figure_cache import FigureCache, serialize_figure
+from downsample import lttb, visible_indices
+from leader_timeline import LeaderTimeline, TimelineBar
+from logger import logger
+from metrics import metrics, instrument_callback
+from multi_chat import Chat, CrossChatAnalytics
+from pesun_calendar import TIMEZONE
+from window_index import WindowIndex, day_start, day_end
 import dash
-from dash import dcc, html, Input, Output
+import flask
+from dash import dcc, html, Input, Output, State, ClientsideFunction
 import plotly.express as px
 import plotly.io as pio
 import plotly.graph_objects as go
 import pandas as pd
 import os
+from typing import Callable
 from utils import *
 from plotly.colors import sample_colorscale, sequential
 import numpy as np
@@ -36,7 +46,7 @@ def user_dropdown(analytics: Analytics):
         dcc.Dropdown(
             id="user_dropdown",
             options=users,
-            value=users[0],
+            value=users[0] if len(users) > 0 else None,
             clearable=False,
             style={
                 "fontFamily": "Avenir Next",
@@ -52,16 +62,35 @@ def user_dropdown(analytics: Analytics):
         "padding": "20px"
     })
 
-def best_player_history(analytics: Analytics):
-    history = analytics.get_best_players_history()
-    def entry_duration(entry):
-        return format_duration(entry[2] - entry[1])
+def leader_colors(leader_timeline: LeaderTimeline) -> dict[str, str]:
+    colors = {}
+    palette = px.colors.qualitative.Plotly
+    for bar in leader_timeline.levels[0].bars:
+        if bar.leader not in colors:
+            colors[bar.leader] = palette[len(colors) % len(palette)]
+    return colors
+
+def leaders_summary(bar: TimelineBar) -> str:
+    total = sum(bar.durations.values())
+    shares = sorted(bar.durations.items(), key=lambda entry: entry[1], reverse=True)
+    summary = ", ".join(f"{user} {round(100 * duration / total) if total > 0 else 100}%" for user, duration in shares)
+    if bar.changes > 0:
+        summary += f" ({format_plural(bar.changes, "change")})"
+    return summary
+
+# Periods shorter than the screen can show are merged, and the visible range is queried again on zoom
+def best_player_history_figure(leader_timeline: LeaderTimeline, colors: dict[str, str], x_range: tuple[str, str] = None):
+    start, end = leader_timeline.start(), leader_timeline.end()
+    if x_range is not None:
+        start, end = pd.Timestamp(x_range[0]).timestamp(), pd.Timestamp(x_range[1]).timestamp()
+    bars = leader_timeline.query(start, end, int(os.getenv("TIMELINE_BARS", "500")))
     df = pd.DataFrame({
-        "User": list(map(lambda entry : entry[0], history)),
-        "Start": pd.to_datetime(list(map(lambda entry : entry[1], history)), utc=True),
-        "End": pd.to_datetime(list(map(lambda entry : entry[2], history)), utc=True),
-        "Period": list(range(1, len(history) + 1)),
-        "Duration": list(map(entry_duration, history)),
+        "User": list(map(lambda bar: bar.leader, bars)),
+        "Start": pd.to_datetime(list(map(lambda bar: bar.start, bars)), unit="s", utc=True),
+        "End": pd.to_datetime(list(map(lambda bar: bar.end, bars)), unit="s", utc=True),
+        "Period": list(map(lambda bar: bar.first_period, bars)),
+        "Duration": list(map(lambda bar: format_duration(timedelta(seconds=round(bar.end - bar.start))), bars)),
+        "Leaders": list(map(leaders_summary, bars)),
     })
     fig = px.timeline(
         df,
@@ -69,14 +98,40 @@ def best_player_history(analytics: Analytics):
         x_end="End",
         y="Period",
         color="User",
+        color_discrete_map=colors,
         title="Best Player History",
-        hover_data={"User": True, "Start": True, "End": True, "Duration": True, "Period": False},
+        hover_data={"User": True, "Start": True, "End": True, "Duration": True, "Leaders": True, "Period": False},
     )
+    fig.update_layout(uirevision="best_player_history")
+    return fig
+
+def best_player_history(leader_timeline: LeaderTimeline, colors: dict[str, str]):
     return html.Div([
-        dcc.Graph(figure=fig),
+        dcc.Graph(figure=best_player_history_figure(leader_timeline, colors), id="best_player_history"),
     ])
 
-def user_statistics(analytics: Analytics):
+# Everything the browser needs to draw the events histograms and numeric statistics of every user.
+# Sent once with the page, so switching users doesn't reach the server
+def user_statistics_data(analytics: Analytics) -> dict:
+    users = {}
+    for user, summary in analytics.get_user_summaries().items():
+        deltas = analytics.get_user_deltas(user)
+        users[user] = {
+            "times": [int(wall_clock_seconds(entry[0])) for entry in deltas],
+            "deltas": [entry[1] for entry in deltas],
+            "best_rank": summary.best_rank,
+            "events_count": summary.events_count,
+            "average_interval": summary.average_interval.total_seconds(),
+            "best_streak": summary.best_streak[2],
+            "last_streak": summary.last_streak_count,
+            "streak_deadline": summary.streak_deadline,
+        }
+    return {
+        "template": go.Figure().layout.template.to_plotly_json(),
+        "users": users,
+    }
+
+def user_statistics(analytics: Analytics, clientside: bool):
     def length_history():
         return dcc.Graph(id="user_length_history")
     
@@ -149,13 +204,16 @@ def user_statistics(analytics: Analytics):
             "paddingRight": "20px",
         })
 
-    return html.Div([
+    children = [
         html.H2("User Statistics"),
         user_dropdown(analytics),
         length_history(),
         numeric_statistics(),
         event_statistics(),
-    ])
+    ]
+    if clientside:
+        children.append(dcc.Store(id="user_statistics_data", data=user_statistics_data(analytics)))
+    return html.Div(children)
 
 def top_player_pie_figure(analytics: Analytics):
     durations = analytics.get_user_domination_durations()
@@ -180,12 +238,12 @@ def top_player_pie_figure(analytics: Analytics):
     return fig
 
 def events_pie_figure(analytics: Analytics):
-    events = analytics.get_all_deltas()
-    df = pd.DataFrame({
-        "User": list(map(lambda entry: entry[0], events)),
-    })
-    df_counts = df.value_counts("User").reset_index()
-    df_counts.columns = ["User", "Count"]
+    users = sorted(analytics.get_users())
+    counts = [analytics.get_user_events_count(user) for user in users]
+    df_counts = pd.DataFrame({
+        "User": users,
+        "Count": counts,
+    }).sort_values("Count", ascending=False, kind="stable")
     fig = px.pie(
         df_counts,
         names="User",
@@ -198,9 +256,10 @@ def events_pie_figure(analytics: Analytics):
     return fig
 
 def user_rankings_panel(analytics: Analytics):
+    summaries = list(analytics.get_user_summaries().values())
+
     def average_interval():
-        users = analytics.get_users()
-        average_intervals = list(map(lambda user: (user, analytics.get_user_average_interval(user)), users))
+        average_intervals = list(map(lambda summary: (summary.user, summary.average_interval), summaries))
         average_intervals = sorted(average_intervals, key=lambda entry: entry[1], reverse=True)
         df = pd.DataFrame({
             "User": list(map(lambda entry: entry[0], average_intervals)),
@@ -226,8 +285,7 @@ def user_rankings_panel(analytics: Analytics):
         )
     
     def longest_streak():
-        users = analytics.get_users()
-        longest_streaks = list(map(lambda user: (user, analytics.get_user_best_streak(user)), users))
+        longest_streaks = list(map(lambda summary: (summary.user, summary.best_streak), summaries))
         longest_streaks = sorted(longest_streaks, key=lambda entry: entry[1][2])
         df = pd.DataFrame({
             "User": list(map(lambda entry: entry[0], longest_streaks)),
@@ -253,8 +311,7 @@ def user_rankings_panel(analytics: Analytics):
         )
     
     def current_streak():
-        users = analytics.get_users()
-        current_streaks = list(map(lambda user: (user, analytics.get_user_current_streak(user)), users))
+        current_streaks = list(map(lambda summary: (summary.user, summary.current_streak), summaries))
         current_streaks = sorted(filter(lambda entry: entry[1] > 0, current_streaks), key=lambda entry: entry[1])
         df = pd.DataFrame({
             "User": list(map(lambda entry: entry[0], current_streaks)),
@@ -342,129 +399,494 @@ def user_rankings_panel(analytics: Analytics):
         }),
     ])
 
-def init(analytics: Analytics):
-    app = dash.Dash(__name__)
-    pio.templates["fonts"] = go.layout.Template(
-        layout=go.Layout(title_font=dict(family="Avenir Next", size=24))
+def time_window_figures(index: WindowIndex, start: datetime, end: datetime):
+    statistics = sorted(index.statistics(start, end).values(), key=lambda entry: entry.gain)
+    df = pd.DataFrame({
+        "User": [entry.user for entry in statistics],
+        "Gain": [entry.gain for entry in statistics],
+        "Length": [entry.length for entry in statistics],
+        "Events": [entry.events_count for entry in statistics],
+    })
+    fig_gain = px.bar(
+        df,
+        x="User",
+        y="Gain",
+        color_discrete_sequence=["DeepSkyBlue"],
+        title="Length Gained",
+        hover_data=["User", "Gain", "Length"],
     )
-    pio.templates.default = 'plotly_dark+fonts'
-    app.layout = html.Div([
-       html.H1(
-        "Pesun Analytics",
-        style={
+    fig_events = px.bar(
+        df.sort_values("Events", kind="stable"),
+        x="User",
+        y="Events",
+        color_discrete_sequence=["DeepSkyBlue"],
+        title="Events Count",
+    )
+    intervals = sorted(filter(lambda entry: entry.events_count > 1, statistics), key=lambda entry: entry.average_interval, reverse=True)
+    fig_interval = px.bar(
+        pd.DataFrame({
+            "User": [entry.user for entry in intervals],
+            "Days": [entry.average_interval.total_seconds() / (24*60*60) for entry in intervals],
+        }),
+        y="User",
+        x="Days",
+        title="Average Interval",
+        orientation="h",
+        color_discrete_sequence=["DeepSkyBlue"],
+    )
+    durations = sorted(index.domination_durations(start, end).items(), key=lambda entry: entry[1], reverse=True)
+    fig_leader = px.pie(
+        pd.DataFrame({
+            "User": [entry[0] for entry in durations],
+            "Days": [entry[1].total_seconds() / (24*60*60) for entry in durations],
+        }),
+        names="User",
+        values="Days",
+        title="Time as Best Player",
+    )
+    fig_leader.update_layout(showlegend=False)
+    return fig_gain, fig_events, fig_interval, fig_leader
+
+# Statistics of the picked days, the last month of the chat at first. A chat without events has no days to pick
+def time_window_panel(index: WindowIndex):
+    if index.first is None:
+        return html.Div()
+    first = datetime.fromtimestamp(index.first, TIMEZONE).date()
+    last = datetime.fromtimestamp(index.last, TIMEZONE).date()
+    def graph(id: str):
+        return html.Div(
+            dcc.Graph(id=id, style={"height": "100%", "width": "100%"}, config={"responsive": True}),
+            style={"flex": "1 1 45%"},
+        )
+    return html.Div([
+        html.H2("Time Window"),
+        dcc.DatePickerRange(
+            id="window_dates",
+            min_date_allowed=first,
+            max_date_allowed=last,
+            start_date=max(first, last - timedelta(days=30)),
+            end_date=last,
+            display_format="YYYY-MM-DD",
+        ),
+        html.Div([
+            graph("window_gain"),
+            graph("window_events"),
+            graph("window_interval"),
+            graph("window_leader"),
+        ], style={
+            "display": "flex",
+            "flexDirection": "row",
+            "flexWrap": "wrap",
+            "gap": "20px",
             "marginTop": "20px",
-            "marginBottom": "40px",
         }),
-        current_length(analytics),
-        best_player_history(analytics),
-        user_statistics(analytics),
-        user_rankings_panel(analytics),
     ])
-    @app.callback(
-        Output("user_length_history", "figure"),
-        Input("user_dropdown", "value"))
-    def update_user_length(user: str):
+
+# Plotly shows dates in their own UTC offset, so points and axis ranges are compared in wall clock seconds
+def wall_clock_seconds(date: datetime) -> float:
+    return date.timestamp() + date.utcoffset().total_seconds()
+
+def relayout_x_range(relayout_data: dict) -> tuple[str, str]:
+    if "xaxis.range[0]" in relayout_data:
+        return relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]
+    if "xaxis.range" in relayout_data:
+        return tuple(relayout_data["xaxis.range"])
+    return None
+
+# Only the visible part of the history is sent, downsampled to a fixed number of points
+def user_length_figure(analytics: Analytics, user: str, x_range: tuple[str, str] = None):
+    if x_range is None:
         history = analytics.get_user_length_history(user)
-        df = pd.DataFrame({
-            "Date": list(map(lambda entry: entry[0], history)),
-            "Length": list(map(lambda entry: entry[1], history)),
-        })
-        fig = px.line(df, x="Date", y="Length", title=f"{user}'s Length History")
-        streaks = list(filter(lambda streak: streak[2] > 1, analytics.get_user_streaks(user)))
-        count = 10
-        streaks = sorted(streaks, key=lambda streak: streak[2], reverse=True)[:count]
-        for i in range(len(streaks)):
-            streak = streaks[i]
-            color = sample_colorscale(sequential.Aggrnyl_r, i / (count-1), colortype="hex")[0]
-            color = f"rgb({color[0]},{color[1]},{color[2]})"
-            name = f"Streak #{i+1}"
-            fig.add_trace(
-                go.Scatter(
-                    x=[streak[0], streak[1]],
-                    y=[0, 0],
-                    mode="lines",
-                    line=dict(color=color, width=10),
-                    hoverinfo="text",
-                    text=f"{name}<br>Duration: {format_plural(streak[2], "day")}<br>Start: {format_date(streak[0])}<br>End: {format_date(streak[1])}",
-                    name=name
-                )
+    else:
+        visible_start, visible_end = pd.Timestamp(x_range[0]).timestamp(), pd.Timestamp(x_range[1]).timestamp()
+        # The range is in wall clock time, and UTC offsets are never larger than 14 hours
+        margin = 14 * 60 * 60
+        history = analytics.get_user_length_history(
+            user, datetime.fromtimestamp(visible_start - margin, timezone.utc), datetime.fromtimestamp(visible_end + margin, timezone.utc)
+        )
+    indices = np.arange(len(history))
+    if len(history) > 0:
+        x = np.array([wall_clock_seconds(entry[0]) for entry in history])
+        y = np.array([entry[1] for entry in history])
+        if x_range is not None:
+            indices = visible_indices(x, visible_start, visible_end)
+        max_points = int(os.getenv("LENGTH_HISTORY_POINTS", "2000"))
+        indices = indices[lttb(x[indices], y[indices], max_points)]
+    points = [history[index] for index in indices.tolist()]
+    df = pd.DataFrame({
+        "Date": list(map(lambda entry: entry[0], points)),
+        "Length": list(map(lambda entry: entry[1], points)),
+    })
+    render_mode = "webgl" if len(points) > int(os.getenv("WEBGL_THRESHOLD", "1000")) else "svg"
+    fig = px.line(df, x="Date", y="Length", title=f"{user}'s Length History", render_mode=render_mode)
+    # Keeps the zoom of the user while the downsampled figure is replaced
+    fig.update_layout(uirevision=user)
+    streaks = list(filter(lambda streak: streak[2] > 1, analytics.get_user_streaks(user)))
+    count = 10
+    streaks = sorted(streaks, key=lambda streak: streak[2], reverse=True)[:count]
+    for i in range(len(streaks)):
+        streak = streaks[i]
+        color = sample_colorscale(sequential.Aggrnyl_r, i / (count-1), colortype="hex")[0]
+        color = f"rgb({color[0]},{color[1]},{color[2]})"
+        name = f"Streak #{i+1}"
+        fig.add_trace(
+            go.Scatter(
+                x=[streak[0], streak[1]],
+                y=[0, 0],
+                mode="lines",
+                line=dict(color=color, width=10),
+                hoverinfo="text",
+                text=f"{name}<br>Duration: {format_plural(streak[2], "day")}<br>Start: {format_date(streak[0])}<br>End: {format_date(streak[1])}",
+                name=name
             )
-        return fig
+        )
+    return fig
+
+def user_events_figures(analytics: Analytics, user: str):
+    deltas = analytics.get_user_deltas(user)
+    df = pd.DataFrame({
+        "Date": list(map(lambda entry: entry[0], deltas)),
+        "Delta": list(map(lambda entry: entry[1], deltas)),
+    })
+    # Dates keep their own UTC offsets, that pandas can't put into one datetime column when DST
+    # changes, so the day and hour are taken from every date directly
+    day_names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+    df_day = pd.DataFrame({
+        "Day": list(map(lambda entry: day_names[entry[0].weekday()], deltas))
+    })
+    df_hour = pd.DataFrame({
+        "Hour": list(map(lambda entry: entry[0].hour, deltas)),
+    })
+    df_delta = pd.DataFrame({
+        "Delta": df["Delta"]
+    })
+    fig_day = px.histogram(
+        df_day,
+        x="Day",
+        category_orders={"Day": day_names},
+        title=f"Events by Day",
+        color_discrete_sequence=["DeepSkyBlue"],
+    )
+    fig_time = px.histogram(
+        df_hour,
+        x="Hour",
+        title=f"Events by Hour",
+        color_discrete_sequence=["DeepSkyBlue"],
+        nbins=24,
+    )
+    fig_time.update_traces(
+        hovertemplate="Interval: %{x:02d}:00 - %{customdata:02d}:00<br>Count: %{y}<extra></extra>",
+        customdata=[(h + 1) % 24 for h in range(24)],
+    )
+    fig_delta = px.histogram(
+        df_delta,
+        x="Delta",
+        title=f"Events by Delta",
+        color_discrete_sequence=["DeepSkyBlue"],
+        nbins=16
+    )
+    return fig_day, fig_time, fig_delta
+
+def serialize_figures(figs: tuple) -> tuple:
+    return tuple(serialize_figure(fig) for fig in figs)
+
+# Builds the per-user figures of the most active users ahead of the first request
+def warm_up_figure_cache(chat: str, analytics: Analytics, figure_cache: FigureCache, count: int):
+    summaries = sorted(analytics.get_user_summaries().values(), key=lambda summary: summary.events_count, reverse=True)
+    for summary in summaries[:count]:
+        user = summary.user
+        figure_cache.get_or_build((chat, "user_length", user, analytics.version), lambda: serialize_figure(user_length_figure(analytics, user)))
+        figure_cache.get_or_build((chat, "user_events", user, analytics.version), lambda: serialize_figures(user_events_figures(analytics, user)))
+    logger.info(f"[FigureCache] Warmed up figures of {min(count, len(summaries))} users of {chat}")
+    figure_cache.log_stats()
+
+# Keeps the value built for the latest analytics version only
+class VersionedValue:
+    def __init__(self, build: Callable[[], object]):
+        self.build = build
+        self.version: int = None
+        self.value = None
+
+    def get(self, version: int):
+        if self.version != version:
+            self.value = self.build()
+            self.version = version
+        return self.value
+
+def cross_chat_lengths_figure(cross_chat: CrossChatAnalytics):
+    leaderboard = cross_chat.leaderboard()
+    users = [totals.user for totals in leaderboard]
+    fig = go.Figure()
+    for chat in cross_chat.chats:
+        fig.add_bar(name=chat, x=users, y=[totals.chat_lengths.get(chat, 0) for totals in leaderboard])
+    fig.update_layout(barmode="stack", title="Length by User in All Chats", xaxis_title="User", yaxis_title="Length")
+    return fig
+
+def cross_chat_table(cross_chat: CrossChatAnalytics):
+    header = ["#", "User", "Length", "Events", "Best Rank", "Leader", "Chats"]
+    rows = []
+    for rank, totals in enumerate(cross_chat.leaderboard(), start=1):
+        rows.append(html.Tr([
+            html.Td(rank),
+            html.Td(totals.user),
+            html.Td(totals.length),
+            html.Td(totals.events_count),
+            html.Td(f"#{totals.best_rank}"),
+            html.Td(format_plural(totals.leader_duration.days, "day")),
+            html.Td(", ".join(totals.chat_lengths.keys())),
+        ]))
+    return html.Table([
+        html.Thead(html.Tr([html.Th(name) for name in header])),
+        html.Tbody(rows),
+    ], style={"width": "100%", "textAlign": "left"})
+
+def cross_chat_panel(cross_chat: CrossChatAnalytics):
+    return html.Div([
+        dcc.Graph(figure=cross_chat_lengths_figure(cross_chat)),
+        html.H2("Leaderboard"),
+        cross_chat_table(cross_chat),
+    ])
+
+# Dropdown value of the merged analytics of all chats
+ALL_CHATS = "*"
+
+def chat_dropdown(chats: list[Chat]):
+    options = [{"label": chat.name, "value": chat.name} for chat in chats]
+    if len(chats) > 1:
+        options.append({"label": "All chats", "value": ALL_CHATS})
+    return html.Div([
+        html.H4("Select Chat"),
+        dcc.Dropdown(
+            id="chat_dropdown",
+            options=options,
+            value=chats[0].name,
+            clearable=False,
+            style={
+                "fontFamily": "Avenir Next",
+                "fontSize": "1rem",
+                "flex": "1"
+            },
+        ),
+    ], style={
+        "display": "flex" if len(chats) > 1 else "none",
+        "flexDirection": "row",
+        "alignItems": "center",
+        "gap": "20px",
+        "padding": "20px"
+    })
+
+# Layout and leader timeline of one chat, rebuilt only when its analytics change
+class ChatView:
+    def __init__(self, chat: Chat, clientside: bool):
+        self.name = chat.name
+        self.analytics = chat.analytics
+        self.clientside = clientside
+        self.leader_timelines = VersionedValue(self.__build_leader_timeline)
+        self.window_indexes = VersionedValue(self.analytics.get_window_index)
+        self.layouts = VersionedValue(self.__build_layout)
+
+    def __build_leader_timeline(self) -> tuple[LeaderTimeline, dict[str, str]]:
+        leader_timeline = LeaderTimeline(self.analytics.get_best_players_history())
+        return leader_timeline, leader_colors(leader_timeline)
+
+    def __build_layout(self):
+        leader_timeline, colors = self.leader_timelines.get(self.analytics.version)
+        return html.Div([
+            current_length(self.analytics),
+            best_player_history(leader_timeline, colors),
+            user_statistics(self.analytics, self.clientside),
+            user_rankings_panel(self.analytics),
+            time_window_panel(self.window_index()),
+        ])
+
+    def leader_timeline(self) -> tuple[LeaderTimeline, dict[str, str]]:
+        return self.leader_timelines.get(self.analytics.version)
+
+    def window_index(self) -> WindowIndex:
+        return self.window_indexes.get(self.analytics.version)
+
+    def layout(self):
+        with self.analytics.lock:
+            return self.layouts.get(self.analytics.version)
+
+def create_app(chats: list[Chat]) -> dash.Dash:
+    # Components of a chat are only in the page while the chat is selected
+    app = dash.Dash(__name__, suppress_callback_exceptions=True)
+    pio.templates["fonts"] = go.layout.Template(
+        layout=go.Layout(title_font=dict(family="Avenir Next", size=24))
+    )
+    pio.templates.default = 'plotly_dark+fonts'
+    figure_cache = FigureCache(int(os.getenv("FIGURE_CACHE_SIZE", "256")))
+    clientside = os.getenv("CLIENTSIDE_STATISTICS") == "TRUE"
+    views = {chat.name: ChatView(chat, clientside) for chat in chats}
+    cross_chat_panels = VersionedValue(lambda: cross_chat_panel(CrossChatAnalytics(chats)))
+    def analytics_version() -> tuple[int, ...]:
+        return tuple(chat.analytics.version for chat in chats)
+    # Layout is served for every page load, so a reload shows analytics updated in the meantime
+    def serve_layout():
+        with metrics.span("dash_layout"):
+            return html.Div([
+                html.H1(
+                    "Pesun Analytics",
+                    style={
+                        "marginTop": "20px",
+                        "marginBottom": "40px",
+                    }),
+                chat_dropdown(chats),
+                html.Div(views[chats[0].name].layout(), id="chat_content"),
+            ])
+    app.layout = serve_layout
+    metrics.gauge("analytics_version", lambda: max(analytics_version()))
+    metrics.gauge("figure_cache_size", lambda: len(figure_cache))
+    @app.server.route("/metrics")
+    def serve_metrics():
+        return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    # Switching chats only swaps layouts, that were built when the app started
+    @app.callback(
+        Output("chat_content", "children"),
+        Input("chat_dropdown", "value"),
+        prevent_initial_call=True)
+    @instrument_callback("switch_chat")
+    def switch_chat(chat: str):
+        if chat == ALL_CHATS:
+            return cross_chat_panels.get(analytics_version())
+        return views[chat].layout()
+
+    @app.callback(
+        Output("user_length_history", "figure"),
+        Input("user_dropdown", "value"),
+        Input("user_length_history", "relayoutData"),
+        State("chat_dropdown", "value"))
+    @instrument_callback("update_user_length")
+    def update_user_length(user: str, relayout_data: dict, chat: str):
+        x_range = None
+        if dash.ctx.triggered_id == "user_length_history":
+            relayout_data = relayout_data or {}
+            x_range = relayout_x_range(relayout_data)
+            if x_range is None and "xaxis.autorange" not in relayout_data:
+                return dash.no_update
+        analytics = views[chat].analytics
+        with analytics.lock:
+            # Zoomed figures are rarely asked for twice, caching them would evict the default ones
+            if x_range is not None:
+                return user_length_figure(analytics, user, x_range)
+            return figure_cache.get_or_build((chat, "user_length", user, analytics.version), lambda: serialize_figure(user_length_figure(analytics, user)))
+
+    @app.callback(
+        Output("best_player_history", "figure"),
+        Input("best_player_history", "relayoutData"),
+        State("chat_dropdown", "value"),
+        prevent_initial_call=True)
+    @instrument_callback("update_best_player_history")
+    def update_best_player_history(relayout_data: dict, chat: str):
+        relayout_data = relayout_data or {}
+        x_range = relayout_x_range(relayout_data)
+        if x_range is None and "xaxis.autorange" not in relayout_data:
+            return dash.no_update
+        view = views[chat]
+        with view.analytics.lock:
+            leader_timeline, colors = view.leader_timeline()
+            if x_range is not None:
+                return best_player_history_figure(leader_timeline, colors, x_range)
+            return figure_cache.get_or_build((chat, "best_player_history", view.analytics.version), lambda: serialize_figure(best_player_history_figure(leader_timeline, colors)))
 
     @app.callback(
+        Output("window_gain", "figure"),
+        Output("window_events", "figure"),
+        Output("window_interval", "figure"),
+        Output("window_leader", "figure"),
+        Input("window_dates", "start_date"),
+        Input("window_dates", "end_date"),
+        State("chat_dropdown", "value"))
+    @instrument_callback("update_time_window")
+    def update_time_window(start_date: str, end_date: str, chat: str):
+        if start_date is None or end_date is None:
+            return dash.no_update
+        view = views[chat]
+        with view.analytics.lock:
+            index = view.window_index()
+            key = (chat, "time_window", view.analytics.version, start_date[:10], end_date[:10])
+            return figure_cache.get_or_build(key, lambda: serialize_figures(time_window_figures(index, day_start(start_date), day_end(end_date))))
+
+    numeric_outputs = [
         Output("user_best_rank", "children"),
         Output("user_events", "children"),
         Output("user_average_interval", "children"),
         Output("user_longest_streak", "children"),
         Output("user_current_streak", "children"),
-        Input("user_dropdown", "value"))
-    def update_user_numerics(user: str):
-        best_rank = analytics.get_user_best_rank(user)
-        events_count = analytics.get_user_events_count(user)
-        average_interval = analytics.get_user_average_interval(user)
-        interval_days = round(average_interval.total_seconds() / (60 * 60 * 24), 2)
-        best_streak = analytics.get_user_best_streak(user)[2]
-        current_streak = analytics.get_user_current_streak(user)
-        return f"#{best_rank}", events_count, f"{interval_days} days", format_plural(best_streak, "day"), format_plural(current_streak, "day")
-    
-    @app.callback(
+    ]
+    events_outputs = [
         Output("user_events_day", "figure"),
         Output("user_events_time", "figure"),
         Output("user_events_delta", "figure"),
-        Input("user_dropdown", "value"))
-    def update_user_events(user: str):
-        deltas = analytics.get_user_deltas(user)
-        df = pd.DataFrame({
-            "Date": list(map(lambda entry: entry[0], deltas)),
-            "Delta": list(map(lambda entry: entry[1], deltas)),
-        })
-        df_day = pd.DataFrame({
-            "Day": df["Date"].dt.day_name()
-        })
-        df_hour = pd.DataFrame({
-            "Hour": df["Date"].dt.hour,
-        })
-        df_delta = pd.DataFrame({
-            "Delta": df["Delta"]
-        })
-        fig_day = px.histogram(
-            df_day,
-            x="Day",
-            category_orders={"Day": ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]},
-            title=f"Events by Day",
-            color_discrete_sequence=["DeepSkyBlue"],
-        )
-        fig_time = px.histogram(
-            df_hour,
-            x="Hour",
-            title=f"Events by Hour",
-            color_discrete_sequence=["DeepSkyBlue"],
-            nbins=24,
-        )
-        fig_time.update_traces(
-            hovertemplate="Interval: %{x:02d}:00 - %{customdata:02d}:00<br>Count: %{y}<extra></extra>",
-            customdata=[(h + 1) % 24 for h in range(24)],
-        )
-        fig_delta = px.histogram(
-            df_delta,
-            x="Delta",
-            title=f"Events by Delta",
-            color_discrete_sequence=["DeepSkyBlue"],
-            nbins=16
-        )
-        return fig_day, fig_time, fig_delta
-    
+    ]
+    if clientside:
+        app.clientside_callback(
+            ClientsideFunction(namespace="user_statistics", function_name="numerics"),
+            *numeric_outputs,
+            Input("user_dropdown", "value"),
+            Input("user_statistics_data", "data"))
+        app.clientside_callback(
+            ClientsideFunction(namespace="user_statistics", function_name="events"),
+            *events_outputs,
+            Input("user_dropdown", "value"),
+            Input("user_statistics_data", "data"))
+    else:
+        @app.callback(
+            *numeric_outputs,
+            Input("user_dropdown", "value"),
+            State("chat_dropdown", "value"))
+        @instrument_callback("update_user_numerics")
+        def update_user_numerics(user: str, chat: str):
+            analytics = views[chat].analytics
+            with analytics.lock:
+                summary = analytics.get_user_summaries()[user]
+            interval_days = round(summary.average_interval.total_seconds() / (60 * 60 * 24), 2)
+            return f"#{summary.best_rank}", summary.events_count, f"{interval_days} days", format_plural(summary.best_streak[2], "day"), format_plural(summary.current_streak, "day")
+
+        @app.callback(
+            *events_outputs,
+            Input("user_dropdown", "value"),
+            State("chat_dropdown", "value"))
+        @instrument_callback("update_user_events")
+        def update_user_events(user: str, chat: str):
+            analytics = views[chat].analytics
+            with analytics.lock:
+                return figure_cache.get_or_build((chat, "user_events", user, analytics.version), lambda: serialize_figures(user_events_figures(analytics, user)))
+
     @app.callback(
         Output("top_player_pie", "figure"),
         Output("events_pie", "figure"),
-        Input("pies_refresh", "n_intervals")
+        Input("pies_refresh", "n_intervals"),
+        State("chat_dropdown", "value")
     )
-    def refresh_pie(n):
+    @instrument_callback("refresh_pie")
+    def refresh_pie(n, chat: str):
         if n > 1:
             return dash.no_update
-        fig_top_player = top_player_pie_figure(analytics)
-        fig_events = events_pie_figure(analytics)
+        analytics = views[chat].analytics
+        with analytics.lock:
+            fig_top_player = top_player_pie_figure(analytics)
+            fig_events = events_pie_figure(analytics)
         return fig_top_player, fig_events
-    
+
+    warmup = int(os.getenv("FIGURE_CACHE_WARMUP", "0"))
+    for view in views.values():
+        warm_up_figure_cache(view.name, view.analytics, figure_cache, warmup)
+    # Built before serving, so that pre-forked workers share them
+    for view in views.values():
+        view.layout()
+    if len(chats) > 1:
+        cross_chat_panels.get(analytics_version())
+    return app
+
+def init(chats: list[Chat]):
+    app = create_app(chats)
+    workers = int(os.getenv("WORKERS", "1"))
+    if workers > 1:
+        from server import serve
+        serve(app.server, workers)
+        return
     is_debug = os.getenv("DEBUG") == "TRUE"
     app.run(host="0.0.0.0", port=8050, debug=is_debug)
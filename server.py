@@ -0,0 +1,33 @@
+from logger import logger
+from gunicorn.app.base import BaseApplication
+from flask import Flask
+import gc
+
+# Runs the app in pre-forked gunicorn workers. The app, together with the analytics it was built
+# from, is created once in this process, and workers share it copy-on-write after the fork
+class PreforkedApplication(BaseApplication):
+    def __init__(self, server: Flask, options: dict):
+        self.server = server
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self) -> Flask:
+        return self.server
+
+def serve(server: Flask, workers: int, host: str = "0.0.0.0", port: int = 8050):
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "preload_app": True,
+        "timeout": 120,
+    }
+    logger.info(f"[Server] Starting {workers} workers on {host}:{port}")
+    # Objects that exist now are never collected, so the garbage collector doesn't
+    # touch their memory in workers and the pages stay shared
+    gc.collect()
+    gc.freeze()
+    PreforkedApplication(server, options).run()
@@ -0,0 +1,65 @@
+from analytics import Analytics, analytics_class
+from classes import Dataset
+from logger import logger
+from cache_folder import cache_folder, cache_path
+from metrics import metrics
+from pathlib import Path
+import os
+import pickle
+import struct
+
+__MAGIC = b"PESUNAN\0"
+# Increase when anything stored in analytics changes, old snapshots are ignored then
+SNAPSHOT_VERSION = 1
+# Magic, version, the fingerprint of the dataset the analytics were built from and the analytics class
+__HEADER = struct.Struct("<8sI40s32s")
+SNAPSHOT_NAME = "analytics.bin"
+
+def save_snapshot(analytics: Analytics, dataset: Dataset):
+    path = cache_path(SNAPSHOT_NAME)
+    os.makedirs(cache_folder(), exist_ok=True)
+    logger.info(f"Saving analytics snapshot to file {path.name}")
+    with metrics.span("cache_save", cache="snapshot"):
+        with analytics.lock:
+            payload = pickle.dumps(analytics, protocol=pickle.HIGHEST_PROTOCOL)
+        temp_path = path.with_suffix(".tmp")
+        with open(temp_path, 'wb') as file:
+            file.write(__HEADER.pack(__MAGIC, SNAPSHOT_VERSION, dataset.deltas.fingerprint().encode(), type(analytics).__name__.encode()))
+            file.write(payload)
+        os.replace(temp_path, path)
+    logger.info(f"Successfuly written analytics snapshot of {len(payload)} bytes")
+
+def load_snapshot(dataset: Dataset) -> Analytics:
+    path = cache_path(SNAPSHOT_NAME)
+    if not path.exists() or not path.is_file():
+        return None
+    with open(path, 'rb') as file:
+        header = file.read(__HEADER.size)
+        if len(header) < __HEADER.size:
+            return None
+        magic, version, fingerprint, class_name = __HEADER.unpack(header)
+        if magic != __MAGIC or version != SNAPSHOT_VERSION:
+            logger.info(f"Analytics snapshot {path.name} has an unsupported format")
+            return None
+        if fingerprint.decode() != dataset.deltas.fingerprint():
+            logger.info(f"Analytics snapshot {path.name} was built from another dataset")
+            return None
+        if class_name.rstrip(b"\0").decode() != analytics_class().__name__:
+            logger.info(f"Analytics snapshot {path.name} was built by another backend")
+            return None
+        try:
+            with metrics.span("cache_load", cache="snapshot"):
+                analytics = pickle.load(file)
+        except Exception:
+            logger.exception(f"Failed to read analytics snapshot {path.name}")
+            return None
+    logger.info(f"Loaded analytics snapshot from file {path.name}")
+    return analytics
+
+# Analytics are only built when there is no snapshot of the same dataset
+def get_analytics(dataset: Dataset) -> Analytics:
+    analytics = load_snapshot(dataset)
+    if analytics is None:
+        analytics = analytics_class()(dataset)
+        save_snapshot(analytics, dataset)
+    return analytics
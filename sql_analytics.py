@@ -0,0 +1,167 @@
+from analytics import Analytics
+from classes import Dataset
+from database import Database, saved_handles, to_datetime
+from datetime import datetime, timedelta
+from window_index import WindowStatistics
+
+# Analytics, that keep only users, ranks, leader periods and streaks in memory. Length histories
+# and deltas of users, the largest part of analytics, are read from the database with indexed queries,
+# so datasets much larger than memory can be served
+class SqlAnalytics(Analytics):
+    keeps_user_histories = False
+
+    def __init__(self, dataset: Dataset):
+        self.database = Database()
+        # The database must have the deltas before summaries are built from it
+        if self.database.fingerprint() != dataset.deltas.fingerprint():
+            self.database.write_dataset(dataset, saved_handles())
+        super().__init__(dataset)
+        self.fingerprint = dataset.deltas.fingerprint()
+        self.database.write_leader_segments(self.best_players_history)
+
+    # A snapshot is only usable together with the database it was built with
+    def __setstate__(self, state: dict):
+        super().__setstate__(state)
+        if self.database.fingerprint() != self.fingerprint:
+            raise ValueError(f"Database {self.database.path.name} doesn't match the analytics snapshot")
+
+    def update(self, dataset: Dataset, appended_from: int):
+        with self.lock:
+            if appended_from is None:
+                self.database.write_dataset(dataset, saved_handles())
+            else:
+                self.database.append_deltas(dataset, appended_from, saved_handles())
+            super().update(dataset, appended_from)
+            self.fingerprint = dataset.deltas.fingerprint()
+            self.database.write_leader_segments(self.best_players_history)
+
+    def __user_id(self, user: str) -> int:
+        rows = self.database.query("SELECT id FROM users WHERE name = ?", (user,))
+        return rows[0][0] if len(rows) > 0 else None
+
+    def get_user_length(self, user: str) -> int:
+        rows = self.database.query(
+            "SELECT length FROM deltas WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT 1", (self.__user_id(user),)
+        )
+        return rows[0][0] if len(rows) > 0 else 0
+
+    def get_user_length_history(self, user: str, start: datetime = None, end: datetime = None) -> list[tuple[datetime, int]]:
+        user_id = self.__user_id(user)
+        if user_id is None:
+            raise KeyError(user)
+        if start is None and end is None:
+            rows = self.database.query("SELECT timestamp, utc_offset, length FROM deltas WHERE user_id = ? ORDER BY timestamp, id", (user_id,))
+            return [(to_datetime(timestamp, offset), length) for timestamp, offset, length in rows]
+        start = start.timestamp() if start is not None else float("-inf")
+        end = end.timestamp() if end is not None else float("inf")
+        # The closest entries outside of the window are included, since they give the length at its edges
+        rows = self.database.query(
+            "SELECT timestamp, utc_offset, length FROM ("
+            " SELECT * FROM (SELECT id, timestamp, utc_offset, length FROM deltas WHERE user_id = ? AND timestamp < ? ORDER BY timestamp DESC, id DESC LIMIT 1)"
+            " UNION ALL SELECT id, timestamp, utc_offset, length FROM deltas WHERE user_id = ? AND timestamp >= ? AND timestamp <= ?"
+            " UNION ALL SELECT * FROM (SELECT id, timestamp, utc_offset, length FROM deltas WHERE user_id = ? AND timestamp > ? ORDER BY timestamp, id LIMIT 1)"
+            ") ORDER BY timestamp, id",
+            (user_id, start, user_id, start, end, user_id, end),
+        )
+        return [(to_datetime(timestamp, offset), length) for timestamp, offset, length in rows]
+
+    def get_user_events_count(self, user: str) -> int:
+        return self.database.query("SELECT COUNT(*) FROM deltas WHERE user_id = ?", (self.__user_id(user),))[0][0]
+
+    def get_user_average_interval(self, user: str) -> timedelta:
+        first, last, count = self.database.query(
+            "SELECT MIN(timestamp), MAX(timestamp), COUNT(*) FROM deltas WHERE user_id = ?", (self.__user_id(user),)
+        )[0]
+        duration = timedelta(seconds=last - first)
+        if count <= 1:
+            return duration
+        return duration / (count - 1)
+
+    def get_user_deltas(self, user: str, start: datetime = None, end: datetime = None) -> list[tuple[datetime, int]]:
+        user_id = self.__user_id(user)
+        if user_id is None:
+            return None
+        start = start.timestamp() if start is not None else float("-inf")
+        end = end.timestamp() if end is not None else float("inf")
+        rows = self.database.query(
+            "SELECT timestamp, utc_offset, delta FROM deltas WHERE user_id = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp, id",
+            (user_id, start, end),
+        )
+        return [(to_datetime(timestamp, offset), delta) for timestamp, offset, delta in rows]
+
+    def get_all_deltas(self) -> list[tuple[str, datetime, int]]:
+        rows = self.database.query(
+            "SELECT users.name, timestamp, utc_offset, delta FROM deltas JOIN users ON users.id = deltas.user_id ORDER BY user_id, timestamp, deltas.id"
+        )
+        return [(user, to_datetime(timestamp, offset), delta) for user, timestamp, offset, delta in rows]
+
+    def get_deltas_between(self, start: datetime, end: datetime) -> list[tuple[str, datetime, int]]:
+        rows = self.database.query(
+            "SELECT users.name, timestamp, utc_offset, delta FROM deltas JOIN users ON users.id = deltas.user_id"
+            " WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp, users.name, deltas.id",
+            (start.timestamp(), end.timestamp()),
+        )
+        return [(user, to_datetime(timestamp, offset), delta) for user, timestamp, offset, delta in rows]
+
+    # Leader periods follow each other, so ordering them by their ends keeps them in order of time
+    def get_best_players_between(self, start: datetime, end: datetime) -> list[tuple[str, datetime, datetime]]:
+        rows = self.database.query(
+            "SELECT users.name, start_time, start_offset, end_time, end_offset FROM leader_segments JOIN users ON users.id = leader_segments.user_id"
+            " WHERE end_time > ? AND start_time < ? ORDER BY end_time, leader_segments.id",
+            (start.timestamp(), end.timestamp()),
+        )
+        return [(user, to_datetime(first, first_offset), to_datetime(last, last_offset)) for user, first, first_offset, last, last_offset in rows]
+
+    def get_window_index(self) -> "SqlWindowIndex":
+        return SqlWindowIndex(self)
+
+# Answers the same statistics of time windows as WindowIndex with a few indexed queries per user,
+# lengths at the edges of the window and the count and bounds of events within it, so deltas are
+# never read into memory
+class SqlWindowIndex:
+    def __init__(self, analytics: SqlAnalytics):
+        self.analytics = analytics
+        self.database = analytics.database
+        self.user_ids = dict(self.database.query("SELECT name, id FROM users"))
+        # Separate subqueries, so both ends are read from the deltas_timestamp index instead of scanning it
+        first, last = self.database.query("SELECT (SELECT MIN(timestamp) FROM deltas), (SELECT MAX(timestamp) FROM deltas)")[0]
+        self.first = float(first) if first is not None else None
+        self.last = float(last) if last is not None else None
+
+    # Length after the last event before the given time
+    def __length_before(self, user_id: int, time: float) -> int:
+        rows = self.database.query(
+            "SELECT length FROM deltas WHERE user_id = ? AND timestamp < ? ORDER BY timestamp DESC, id DESC LIMIT 1", (user_id, time)
+        )
+        return rows[0][0] if len(rows) > 0 else 0
+
+    def __user_statistics(self, user: str, start: datetime, end: datetime, leader_duration: timedelta) -> WindowStatistics:
+        user_id = self.user_ids[user]
+        start, end = start.timestamp(), end.timestamp()
+        count, first, last = self.database.query(
+            "SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM deltas WHERE user_id = ? AND timestamp >= ? AND timestamp < ?", (user_id, start, end)
+        )[0]
+        interval = timedelta(seconds=last - first) if count > 0 else timedelta()
+        if count > 1:
+            interval /= count - 1
+        length = self.__length_before(user_id, end)
+        return WindowStatistics(user, length, length - self.__length_before(user_id, start), count, interval, leader_duration)
+
+    def user_statistics(self, user: str, start: datetime, end: datetime) -> WindowStatistics:
+        return self.__user_statistics(user, start, end, self.domination_durations(start, end).get(user, timedelta()))
+
+    # Users that had events, a length or the lead within the window
+    def statistics(self, start: datetime, end: datetime) -> dict[str, WindowStatistics]:
+        durations = self.domination_durations(start, end)
+        result = {}
+        for user in self.analytics.get_users():
+            statistics = self.__user_statistics(user, start, end, durations.get(user, timedelta()))
+            if statistics.events_count > 0 or statistics.length != 0 or statistics.leader_duration > timedelta():
+                result[user] = statistics
+        return result
+
+    def domination_durations(self, start: datetime, end: datetime) -> dict[str, timedelta]:
+        durations = {}
+        for user, first, last in self.analytics.get_best_players_between(start, end):
+            durations[user] = durations.get(user, timedelta()) + min(last, end) - max(first, start)
+        return {user: duration for user, duration in durations.items() if duration > timedelta()}
@@ -0,0 +1,216 @@
+import argparse
+import html
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Iterator
+import pytz
+
+# Generates Telegram exports, either HTML pages or result.json, with the markup parse_archive expects,
+# for benchmarks and experiments without private chats. Players send /pesun and the bot replies with a change
+# or a reset, sometimes to a message that is missing from the export. Both formats of the same seed have
+# the same messages
+
+BOT_NAME = "Ebobot"
+MESSAGES_PER_PAGE = 1000
+TIMEZONE = pytz.timezone("Europe/Kyiv")
+# Reply to a message that is not in the export, the parser has to use saved handles then
+MISSING_MESSAGE_ID = 7
+
+class SyntheticUser:
+    def __init__(self, name: str, handle: str, nickname: str = None):
+        self.name = name
+        self.handle = handle
+        self.nickname = nickname
+        self.length = 0
+
+    # Text parts in the format of text entities of the JSON export
+    def mention(self) -> list[dict]:
+        if self.handle is None:
+            return [{"type": "plain", "text": self.name.split()[0]}]
+        return [{"type": "mention", "text": f"@{self.handle}"}]
+
+class SyntheticMessage:
+    __slots__ = ("id", "date", "from_name", "parts", "reply_to")
+
+    def __init__(self, id: int, date: datetime, from_name: str, parts: list[dict], reply_to: int = None):
+        self.id = id
+        self.date = date
+        self.from_name = from_name
+        self.parts = parts
+        self.reply_to = reply_to
+
+def html_text(parts: list[dict]) -> str:
+    result = []
+    for part in parts:
+        text = html.escape(part["text"], quote=False).replace("\n", "<br>")
+        result.append(f'<a href="">{text}</a>' if part["type"] == "mention" else text)
+    return "".join(result)
+
+def make_users(count: int) -> list[SyntheticUser]:
+    users = [
+        # Names are escaped in the HTML export
+        SyntheticUser("Carl & Co", None),
+        # Name that nicknames.txt maps to another one
+        SyntheticUser("Dana", "dana", "DanaX"),
+    ]
+    for i in range(len(users), count):
+        users.append(SyntheticUser(f"User{i} Surname", f"user_{i}"))
+    return users[:count]
+
+def title(date: datetime) -> str:
+    local = date.astimezone(TIMEZONE)
+    hours = int(local.utcoffset().total_seconds() // 3600)
+    return local.strftime("%d.%m.%Y %H:%M:%S") + f" UTC+{hours:02d}:00"
+
+def message_block(message: SyntheticMessage, joined: bool) -> str:
+    id, date, reply_to = message.id, message.date, message.reply_to
+    lines = [f'     <div class="message default clearfix{" joined" if joined else ""}" id="message{id}">']
+    if not joined:
+        lines.append('      <div class="pull_left userpic_wrap"><div class="userpic userpic2" style="width: 42px; height: 42px"><div class="initials" style="line-height: 42px">P</div></div></div>')
+    lines.append('      <div class="body">')
+    lines.append(f'       <div class="pull_right date details" title="{title(date)}">\n{date:%H:%M}\n       </div>')
+    if not joined:
+        lines.append(f'       <div class="from_name">\n{html.escape(message.from_name, quote=False)}\n       </div>')
+    if reply_to is not None:
+        lines.append(f'       <div class="reply_to details">\nIn reply to <a href="#go_to_message{reply_to}" onclick="return GoToMessage({reply_to})">this message</a>\n       </div>')
+    lines.append(f'       <div class="text">\n{html_text(message.parts)}\n       </div>')
+    lines.append('      </div>')
+    lines.append('     </div>')
+    return "\n".join(lines)
+
+def bot_text(rng: random.Random, user: SyntheticUser) -> list[dict]:
+    wait = f"Продовжуй грати через {rng.randint(0, 23)} год., {rng.randint(0, 59)} хв."
+    roll = rng.random()
+    if roll < 0.03:
+        user.length = 0
+        return user.mention() + [{"type": "plain", "text": f", в тебе немає песюна.\n{wait}"}]
+    delta = rng.randint(1, 10)
+    if roll < 0.35:
+        user.length -= delta
+        change = f"твій песюн скоротився на {delta} см."
+    else:
+        user.length += delta
+        change = f"твій песюн виріс на {delta} см."
+    return user.mention() + [{"type": "plain", "text": f", {change}\nТепер його довжина: {user.length} см.\n{wait}"}]
+
+def page_header(page: int) -> str:
+    return (
+        '<!DOCTYPE html>\n<html>\n <body>\n  <div class="page_wrap">\n   <div class="page_body chat_page">\n    <div class="history">\n'
+        f'     <div class="message service" id="message-{page}">\n      <div class="body details">\nService message\n      </div>\n     </div>\n'
+    )
+
+PAGE_FOOTER = '\n    </div>\n   </div>\n  </div>\n </body>\n</html>\n'
+
+def page_name(page: int) -> str:
+    return "messages.html" if page == 1 else f"messages{page}.html"
+
+# Events are spread over the given number of days, so that DST changes and the legacy cutoff
+# of November 2022 are crossed with the default start date
+def generate_messages(events: int, players: list[SyntheticUser], days: int, seed: int, start: datetime) -> Iterator[SyntheticMessage]:
+    rng = random.Random(seed)
+    step = days * 24 * 60 * 60 / max(events, 1)
+    date = start
+    id = 100
+    generated = 0
+    while generated < events:
+        date += timedelta(seconds=rng.uniform(0.2, 1.8) * step)
+        # Sometimes two requests come before the bot answers both, or a player writes something first
+        count = 2 if rng.random() < 0.1 and generated + 2 <= events else 1
+        requests = []
+        for _ in range(count):
+            user = rng.choice(players)
+            if rng.random() < 0.05:
+                id += 1
+                yield SyntheticMessage(id, date, user.name, [{"type": "plain", "text": "ну давай"}])
+            id += 1
+            yield SyntheticMessage(id, date, user.name, [{"type": "bot_command", "text": "/pesun@Ebobot"}])
+            requests.append((user, id))
+        for user, request_id in requests:
+            reply_to = request_id if rng.random() > 0.02 else MISSING_MESSAGE_ID
+            reply_date = date + timedelta(seconds=rng.randint(1, 5))
+            id += 1
+            yield SyntheticMessage(id, reply_date, BOT_NAME, bot_text(rng, user), reply_to)
+        generated += count
+
+def write_html(path: Path, messages: Iterator[SyntheticMessage]):
+    page = 0
+    blocks: list[str] = []
+    last_from: str = None
+    def flush():
+        nonlocal page, last_from
+        page += 1
+        with open(path / page_name(page), 'w') as file:
+            file.write(page_header(page))
+            file.write("\n".join(blocks))
+            file.write(PAGE_FOOTER)
+        blocks.clear()
+        last_from = None
+    for message in messages:
+        # Pages end before a new request, so that requests and their replies stay together
+        if len(blocks) >= MESSAGES_PER_PAGE and last_from == BOT_NAME and message.from_name != BOT_NAME:
+            flush()
+        # Consecutive messages of one sender are joined into one block without a name
+        blocks.append(message_block(message, last_from == message.from_name))
+        last_from = message.from_name
+    if len(blocks) > 0:
+        flush()
+
+def json_message(message: SyntheticMessage, from_ids: dict[str, str]) -> dict:
+    local = message.date.astimezone(TIMEZONE)
+    entry = {
+        "id": message.id,
+        "type": "message",
+        "date": local.strftime("%Y-%m-%dT%H:%M:%S"),
+        "date_unixtime": str(int(message.date.timestamp())),
+        "from": message.from_name,
+        "from_id": from_ids[message.from_name],
+    }
+    if message.reply_to is not None:
+        entry["reply_to_message_id"] = message.reply_to
+    parts = message.parts
+    entry["text"] = parts[0]["text"] if len(parts) == 1 and parts[0]["type"] == "plain" else [part["text"] if part["type"] == "plain" else part for part in parts]
+    entry["text_entities"] = parts
+    return entry
+
+# Messages are written one by one, so exports larger than memory can be generated
+def write_json(path: Path, messages: Iterator[SyntheticMessage], players: list[SyntheticUser]):
+    from_ids = {user.name: f"user{index}" for index, user in enumerate(players, start=1)}
+    from_ids[BOT_NAME] = "user0"
+    with open(path / "result.json", 'w', encoding='utf-8') as file:
+        file.write('{\n "name": "Pesun",\n "type": "private_supergroup",\n "id": 1,\n "messages": [\n')
+        service = {"id": 1, "type": "service", "date": "2021-10-01T12:00:00", "date_unixtime": "1633078800", "actor": "Pesun", "action": "create_group", "text": ""}
+        file.write("  " + json.dumps(service, ensure_ascii=False))
+        for message in messages:
+            file.write(",\n  " + json.dumps(json_message(message, from_ids), ensure_ascii=False))
+        file.write("\n ]\n}\n")
+
+def generate_archive(path: Path, events: int, users: int = 6, days: int = 730, seed: int = 1, start: datetime = datetime(2021, 11, 1, tzinfo=timezone.utc), format: str = "html"):
+    path = Path(path)
+    os.makedirs(path, exist_ok=True)
+    players = make_users(max(users, 2))
+    messages = generate_messages(events, players, days, seed, start)
+    if format == "json":
+        write_json(path, messages, players)
+    else:
+        write_html(path, messages)
+    with open(path / "nicknames.txt", 'w') as file:
+        for user in players:
+            if user.nickname is not None:
+                file.write(f"{user.name.split()[0]} {user.nickname}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Telegram export of a pesun chat")
+    parser.add_argument("path", help="folder to write the export to")
+    parser.add_argument("events", type=int, help="number of pesun events")
+    parser.add_argument("--users", type=int, default=6)
+    parser.add_argument("--days", type=int, default=730, help="number of days the events are spread over")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--format", choices=["html", "json"], default="html", help="write HTML pages or result.json")
+    args = parser.parse_args()
+    generate_archive(Path(args.path), args.events, args.users, args.days, args.seed, format=args.format)
+
+if __name__ == "__main__":
+    main()
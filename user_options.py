@@ -6,6 +6,8 @@ from logger import logger
 class UserOptions:
     def __init__(self):
         self.archive_name = None
+        # Every chat that is analyzed, the first one is also the archive_name
+        self.archive_names: list[str] = []
 
 options = None
 
@@ -18,10 +20,15 @@ def read_options():
     logger.info(f"Reading user options from file {path.name}")
     with open(path, 'r') as file:
         dct = {}
+        archive_names = []
         for line in file:
-            key,value = line.strip().split("=")
+            key,value = line.strip().split("=", 1)
             dct[key] = value
-        options.archive_name = dct.get('archive_name')
+            # Written once for every chat
+            if key == 'archive_name':
+                archive_names.append(value)
+        options.archive_name = archive_names[0] if len(archive_names) > 0 else None
+        options.archive_names = archive_names
 
 def write_options():
     global options
@@ -30,13 +37,32 @@ def write_options():
     path.touch(exist_ok=True)
     logger.info(f"Writing user options to file {path.name}")
     with open(path, 'w') as file:
-        if options.archive_name:
-            file.write(f"archive_name={options.archive_name}\n")
+        for archive_name in options.archive_names:
+            file.write(f"archive_name={archive_name}\n")
 
 def get_archive_name() -> str:
     global options
     if options.archive_name is not None:
         return options.archive_name
-    options.archive_name = messenger.request_archive_path()
+    set_archive_name(messenger.request_archive_path())
+    return options.archive_name
+
+def get_archive_names() -> list[str]:
+    global options
+    if len(options.archive_names) == 0:
+        get_archive_name()
+    return options.archive_names
+
+def set_archive_name(archive_name: str):
+    global options
+    if archive_name is None:
+        return
+    set_archive_names([archive_name])
+
+def set_archive_names(archive_names: list[str]):
+    global options
+    if archive_names is None or len(archive_names) == 0:
+        return
+    options.archive_name = archive_names[0]
+    options.archive_names = list(archive_names)
     write_options()
-    return options.archive_name
\ No newline at end of file
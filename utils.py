@@ -2,6 +2,7 @@ from logger import logger
 from datetime import datetime, timezone, timedelta
 import pytz
 from classes import DeltaInstance
+from pesun_calendar import get_calendar
 
 def normalize_date(date: datetime):
     tz = timezone(timedelta(hours=0))
@@ -24,26 +25,18 @@ def same_section(date1: datetime, date2: datetime):
     dts2 = get_dts(date2)
     return dts1 == dts2
 
+def pesun_day(date: datetime) -> int:
+    return get_calendar().day_end(date.timestamp())
+
 def next_pesun_date(date: datetime):
-    tz = pytz.timezone("Europe/Kyiv")
-    date_tz = date.astimezone(tz)
-    shift = 23 if is_legacy(date) else 2
-    dts = get_dts(date_tz)
-    target = (dts*2 + shift)%24
-    next_date = date_tz.replace(hour=target, minute=0, second=0, microsecond=0)
-    while next_date <= date_tz:
-        next_date += timedelta(days=1)
-    return next_date
+    return get_calendar().next_pesun_date(date)
 
 def same_pesun_day(prev: datetime, cur: datetime) -> bool:
-    nx1 = next_pesun_date(prev)
-    nx2 = next_pesun_date(cur)
-    return nx1 == nx2
+    return pesun_day(prev) == pesun_day(cur)
 
 def consecutive_pesun_days(prev: datetime, cur: datetime) -> bool:
-    nx1 = next_pesun_date(next_pesun_date(prev))
-    nx2 = next_pesun_date(cur)
-    return nx1 == nx2
+    calendar = get_calendar()
+    return calendar.next_day_end(pesun_day(prev)) == pesun_day(cur)
 
 def apply_delta(length: int, delta: DeltaInstance) -> int:
     return 0 if delta.is_reset else length+delta.delta
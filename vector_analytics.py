@@ -0,0 +1,245 @@
+from analytics import Analytics, next_analytics_version
+from classes import Dataset, DeltaTable, MISSING_VALUE, offset_timezone
+from leaderboard import Leaderboard
+from pesun_calendar import get_calendar
+from logger import logger
+from metrics import metrics
+from collections.abc import Mapping
+from datetime import datetime, timezone, timedelta
+from time import perf_counter
+from window_index import UserEvents
+from threading import RLock
+from typing import Callable
+import numpy as np
+
+# Per-user values are only turned into Python objects when somebody asks for them
+class LazyUserMap(Mapping):
+    def __init__(self, users: list[str], factory: Callable[[str], object]):
+        self.__users = {user: None for user in users}
+        self.__factory = factory
+        self.__values = {}
+
+    def __getitem__(self, user: str):
+        if user not in self.__users:
+            raise KeyError(user)
+        value = self.__values.get(user)
+        if value is None:
+            value = self.__factory(user)
+            self.__values[user] = value
+        return value
+
+    def __iter__(self):
+        return iter(self.__users)
+
+    def __len__(self) -> int:
+        return len(self.__users)
+
+def segmented_cumsum(values: np.ndarray, segment_starts: np.ndarray) -> np.ndarray:
+    totals = np.cumsum(values)
+    starts = np.maximum.accumulate(np.where(segment_starts, np.arange(len(values)), 0))
+    return totals - totals[starts] + values[starts]
+
+class VectorAnalytics(Analytics):
+
+    def __to_datetime(self, index: int) -> datetime:
+        return datetime.fromtimestamp(self.__timestamps[index], offset_timezone(self.__offsets[index]))
+
+    def __sort_by_user(self, table: DeltaTable):
+        n = len(table)
+        self.__order = np.argsort(table.user_ids, kind="stable")
+        sorted_user_ids = np.asarray(table.user_ids)[self.__order]
+        self.__user_starts = np.zeros(n, dtype=bool)
+        if n > 0:
+            self.__user_starts[0] = True
+            self.__user_starts[1:] = sorted_user_ids[1:] != sorted_user_ids[:-1]
+        starts = np.flatnonzero(self.__user_starts)
+        ends = np.append(starts[1:], n)
+        self.__sorted_user_ids = sorted_user_ids
+        self.__ranges = {table.users[sorted_user_ids[start]]: (start, end) for start, end in zip(starts.tolist(), ends.tolist())}
+
+    # Lengths are cumulative sums of deltas, that start over at every user and every reset
+    def __calculate_lengths(self, table: DeltaTable):
+        is_resets = np.asarray(table.is_resets, dtype=bool)[self.__order]
+        values = np.where(is_resets, 0, np.asarray(table.deltas, dtype=np.int64)[self.__order])
+        self.__sorted_lengths = segmented_cumsum(values, self.__user_starts | is_resets)
+        lengths = np.empty(len(table), dtype=np.int64)
+        lengths[self.__order] = self.__sorted_lengths
+        new_lengths = np.asarray(table.new_lengths)
+        for index in np.flatnonzero((new_lengths != MISSING_VALUE) & (new_lengths != lengths)).tolist():
+            logger.warning(f"Warning! Calculated and provided lengths don't match: user = {table.users[table.user_ids[index]]} time = {self.__to_datetime(index)} expected = {lengths[index]} actual = {new_lengths[index]}")
+        return lengths
+
+    def __calculate_best_players(self, table: DeltaTable, lengths: np.ndarray):
+        leaderboard = Leaderboard()
+        self.best_rank = leaderboard.best_rank
+        starts = []
+        leaders = []
+        cur_best = None
+        names = [table.users[user_id] for user_id in table.user_ids.tolist()]
+        for index, (user, length) in enumerate(zip(names, lengths.tolist())):
+            leaderboard.update(user, length)
+            best = leaderboard.leader()
+            if best != cur_best:
+                starts.append(index)
+                leaders.append(best)
+                cur_best = best
+        self.best_players_history = []
+        for i in range(len(starts)):
+            end = self.__to_datetime(starts[i+1]) if i+1 < len(starts) else datetime.now(timezone.utc)
+            self.best_players_history.append((leaders[i], self.__to_datetime(starts[i]), end))
+
+    # Streak counts go up on consecutive days, start over at 1 after a gap and at 0 after
+    # two events in the same day, the same rules as the row by row calculation
+    def __calculate_streaks(self, table: DeltaTable):
+        calendar = get_calendar()
+        timestamps = np.asarray(table.timestamps)[self.__order]
+        days = calendar.day_ends(timestamps)
+        next_days = calendar.day_ends(days)
+        n = len(days)
+        same = np.zeros(n, dtype=bool)
+        consecutive = np.zeros(n, dtype=bool)
+        same[1:] = ~self.__user_starts[1:] & (days[1:] == days[:-1])
+        consecutive[1:] = ~self.__user_starts[1:] & ~same[1:] & (next_days[:-1] == days[1:])
+        breaks = ~same & ~consecutive
+        for index in np.flatnonzero(same).tolist():
+            original = self.__order[index]
+            prev = self.__order[index-1]
+            logger.warning(f"[Analytics] Warning while calculating streaks! Two events in the same day! user = {table.users[table.user_ids[original]]} prev_date = {self.__to_datetime(prev)} date = {self.__to_datetime(original)}")
+        counts = segmented_cumsum(np.where(same, 0, 1), breaks | same)
+        streak_starts = np.flatnonzero(breaks)
+        streak_ends = np.append(streak_starts[1:], n)[:len(streak_starts)] - 1
+        self.__streak_starts = self.__order[streak_starts]
+        self.__streak_ends = self.__order[streak_ends]
+        self.__streak_counts = counts[streak_ends]
+        streak_users = self.__sorted_user_ids[streak_starts]
+        user_starts = np.flatnonzero(np.append(True, streak_users[1:] != streak_users[:-1])[:len(streak_users)])
+        user_ends = np.append(user_starts[1:], len(streak_users))[:len(user_starts)]
+        self.__streak_ranges = {table.users[streak_users[start]]: (start, end) for start, end in zip(user_starts.tolist(), user_ends.tolist())}
+
+    def __length_history(self, user: str) -> list[tuple[datetime, int]]:
+        start, end = self.__ranges[user]
+        indices = self.__order[start:end].tolist()
+        return [(self.__to_datetime(index), length) for index, length in zip(indices, self.__sorted_lengths[start:end].tolist())]
+
+    def __user_deltas(self, user: str) -> list[tuple[datetime, int]]:
+        start, end = self.__ranges[user]
+        indices = self.__order[start:end].tolist()
+        return [(self.__to_datetime(index), self.__deltas[index]) for index in indices]
+
+    def __streaks(self, user: str) -> list[tuple[datetime, datetime, int]]:
+        start, end = self.__streak_ranges[user]
+        rows = zip(self.__streak_starts[start:end].tolist(), self.__streak_ends[start:end].tolist(), self.__streak_counts[start:end].tolist())
+        return [(self.__to_datetime(first), self.__to_datetime(last), count) for first, last, count in rows]
+
+    def __create_user_maps(self):
+        users = list(self.__ranges.keys())
+        self.user_length_histories = LazyUserMap(users, self.__length_history)
+        self.user_deltas = LazyUserMap(users, self.__user_deltas)
+        self.streaks = LazyUserMap(users, self.__streaks)
+
+    # Lazy maps hold bound methods, that can't be saved, so they are created again on load
+    def __getstate__(self) -> dict:
+        state = super().__getstate__()
+        for name in ["user_length_histories", "user_deltas", "streaks"]:
+            del state[name]
+        return state
+
+    def __setstate__(self, state: dict):
+        super().__setstate__(state)
+        self.__create_user_maps()
+
+    def __init__(self, dataset: Dataset):
+        self.lock = RLock()
+        self.__build(dataset)
+
+    # Vectorized building is fast enough to build everything again instead of extending
+    def update(self, dataset: Dataset, appended_from: int):
+        with self.lock:
+            self.__build(dataset)
+
+    def __build(self, dataset: Dataset):
+        table = dataset.deltas
+        logger.info(f"[Analytics] Starting building vectorized analytics from {len(table)} deltas")
+        self.__timestamps = table.timestamps.tolist()
+        self.__offsets = table.offsets.tolist()
+        self.__deltas = table.deltas.tolist()
+        timings = {}
+        stage_start = perf_counter()
+        self.__sort_by_user(table)
+        self.users = set(self.__ranges.keys())
+        timings["users"] = perf_counter() - stage_start
+
+        stage_start = perf_counter()
+        lengths = self.__calculate_lengths(table)
+        timings["lengths"] = perf_counter() - stage_start
+
+        stage_start = perf_counter()
+        self.__calculate_best_players(table, lengths)
+        timings["best_players"] = perf_counter() - stage_start
+
+        stage_start = perf_counter()
+        self.__calculate_streaks(table)
+        timings["streaks"] = perf_counter() - stage_start
+
+        self.__create_user_maps()
+        stage_start = perf_counter()
+        self.build_user_summaries()
+        timings["summaries"] = perf_counter() - stage_start
+
+        self.stage_timings = timings
+        self.version = next_analytics_version()
+        for name, duration in timings.items():
+            metrics.observe("analytics_stage_seconds", duration, stage=name)
+        report = ", ".join(f"{name} = {duration:.3f}s" for name, duration in timings.items())
+        logger.info(f"[Analytics] Stage timings: {report}")
+        logger.info(f"[Analytics] Done buildng all analytics")
+
+    # Streaks are read from the arrays, so that the lazy streak lists are not built for every user
+    def summarize_streaks(self, user: str) -> tuple[tuple[datetime, datetime, int], tuple[datetime, datetime, int]]:
+        start, end = self.__streak_ranges[user]
+        best = start + int(np.argmax(self.__streak_counts[start:end]))
+        return self.__streak(best), self.__streak(end-1)
+
+    def __streak(self, index: int) -> tuple[datetime, datetime, int]:
+        return self.__to_datetime(self.__streak_starts[index]), self.__to_datetime(self.__streak_ends[index]), int(self.__streak_counts[index])
+
+    def get_user_length(self, user: str) -> int:
+        user_range = self.__ranges.get(user)
+        if user_range is None:
+            return 0
+        return int(self.__sorted_lengths[user_range[1]-1])
+
+    def get_user_events_count(self, user: str) -> int:
+        start, end = self.__ranges[user]
+        return end - start
+
+    def get_user_average_interval(self, user: str) -> timedelta:
+        start, end = self.__ranges[user]
+        first = self.__order[start]
+        last = self.__order[end-1]
+        duration = timedelta(seconds=self.__timestamps[last] - self.__timestamps[first])
+        count = end - start - 1
+        if count <= 0:
+            return duration
+        return duration / count
+
+    # Slices of the arrays sorted by user, without building the lazy histories
+    def get_window_events(self) -> dict[str, UserEvents]:
+        timestamps = np.asarray(self.__timestamps, dtype=np.float64)[self.__order]
+        return {user: UserEvents(timestamps[start:end], self.__sorted_lengths[start:end]) for user, (start, end) in self.__ranges.items()}
+
+    def get_user_domination_durations(self) -> dict[str, timedelta]:
+        history = self.best_players_history
+        if len(history) == 0:
+            return {}
+        users = [entry[0] for entry in history]
+        user_ids = {user: None for user in users}
+        index = {user: i for i, user in enumerate(user_ids)}
+        # Whole seconds for closed periods, the last one ends now and is added separately
+        seconds = np.array([int(entry[2].timestamp() - entry[1].timestamp()) for entry in history[:-1]], dtype=np.int64)
+        totals = np.zeros(len(index), dtype=np.int64)
+        np.add.at(totals, np.array([index[user] for user in users[:-1]], dtype=np.int64), seconds)
+        durations = {user: timedelta(seconds=int(total)) for user, total in zip(index.keys(), totals.tolist())}
+        last = history[-1]
+        durations[last[0]] += last[2] - last[1]
+        return durations
@@ -0,0 +1,64 @@
+from analytics import Analytics
+from classes import Dataset
+from dataset import CacheAction, choose_cache_action, update_dataset
+from manifest import Manifest, load_manifest
+from snapshot import save_snapshot
+from logger import logger
+from metrics import metrics
+from threading import Thread, Event
+from time import perf_counter
+
+# Polls the archive folder and brings the dataset and analytics up to date when message files
+# are added or changed. Only changed files are parsed again, and when the new dataset only adds
+# deltas after the old ones, analytics continue from their current state instead of a full rebuild
+class ArchiveWatcher:
+    def __init__(self, archive_name: str, dataset: Dataset, analytics: Analytics, interval: float):
+        self.archive_name = archive_name
+        self.dataset = dataset
+        self.analytics = analytics
+        self.interval = interval
+        self.__stopped = Event()
+        self.__thread: Thread = None
+
+    def check(self) -> bool:
+        manifest = load_manifest()
+        action = choose_cache_action(self.archive_name, manifest)
+        if action == CacheAction.REUSE:
+            return False
+        start_time = perf_counter()
+        if action == CacheAction.REBUILD:
+            logger.info("[Watcher] Archive was replaced, parsing the whole archive")
+            manifest = Manifest()
+        else:
+            logger.info("[Watcher] Archive has changed, parsing new or changed files")
+        metrics.increment("archive_updates_total", action=action)
+        with metrics.span("archive_update"):
+            dataset = update_dataset(self.archive_name, manifest)
+        old_deltas = self.dataset.deltas
+        appended_from = len(old_deltas) if old_deltas.is_prefix_of(dataset.deltas) else None
+        if appended_from == len(dataset.deltas):
+            logger.info("[Watcher] No new deltas found")
+        else:
+            with metrics.span("analytics_update", mode="rebuild" if appended_from is None else "extend"):
+                self.analytics.update(dataset, appended_from)
+            save_snapshot(self.analytics, dataset)
+        self.dataset = dataset
+        logger.info(f"[Watcher] Update took {perf_counter() - start_time:.3f}s")
+        return True
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("[Watcher] Failed to update analytics from the archive")
+
+    def start(self):
+        logger.info(f"[Watcher] Watching archive {self.archive_name} every {self.interval} seconds")
+        self.__thread = Thread(target=self.__run, name="archive-watcher", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
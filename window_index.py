@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+from pesun_calendar import TIMEZONE
+import numpy as np
+
+# Events of one user sorted by time. Lengths are prefix sums of the deltas, that start over
+# at every reset, so the length at any moment is the last one before it
+class UserEvents:
+    __slots__ = ("timestamps", "lengths")
+
+    def __init__(self, timestamps: np.ndarray, lengths: np.ndarray):
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    @staticmethod
+    def from_history(history: list[tuple[datetime, int]]) -> "UserEvents":
+        return UserEvents([entry[0].timestamp() for entry in history], [entry[1] for entry in history])
+
+    # Indices of the first event at or after start and the first one at or after end
+    def range(self, start: float, end: float) -> tuple[int, int]:
+        return int(np.searchsorted(self.timestamps, start, "left")), int(np.searchsorted(self.timestamps, end, "left"))
+
+    def length_before(self, index: int) -> int:
+        return int(self.lengths[index - 1]) if index > 0 else 0
+
+# Leader periods of one user with running totals of their durations, so the time within
+# a window is the difference of two totals minus the parts of the edge periods outside of it
+class LeaderSegments:
+    __slots__ = ("starts", "ends", "totals")
+
+    def __init__(self, starts: list[float], ends: list[float]):
+        self.starts = np.array(starts, dtype=np.float64)
+        self.ends = np.array(ends, dtype=np.float64)
+        self.totals = np.concatenate(([0.0], np.cumsum(self.ends - self.starts)))
+
+    def duration(self, start: float, end: float) -> float:
+        first = int(np.searchsorted(self.ends, start, "right"))
+        last = int(np.searchsorted(self.starts, end, "left"))
+        if first >= last:
+            return 0.0
+        total = self.totals[last] - self.totals[first]
+        total -= max(0.0, start - self.starts[first])
+        total -= max(0.0, self.ends[last - 1] - end)
+        return float(total)
+
+class WindowStatistics:
+    def __init__(self, user: str, length: int, gain: int, events_count: int, average_interval: timedelta, leader_duration: timedelta):
+        self.user = user
+        self.length = length
+        self.gain = gain
+        self.events_count = events_count
+        self.average_interval = average_interval
+        self.leader_duration = leader_duration
+
+# Answers statistics of any time window with a few binary searches per user, instead of building
+# analytics again over the deltas of the window. Windows include their start and exclude their end
+class WindowIndex:
+    def __init__(self, events: dict[str, UserEvents], best_players_history: list[tuple[str, datetime, datetime]]):
+        self.events = events
+        periods: dict[str, tuple[list[float], list[float]]] = {}
+        for user, start, end in best_players_history:
+            starts, ends = periods.setdefault(user, ([], []))
+            starts.append(start.timestamp())
+            ends.append(end.timestamp())
+        self.leaders = {user: LeaderSegments(starts, ends) for user, (starts, ends) in periods.items()}
+        timestamps = [user_events.timestamps for user_events in events.values() if len(user_events.timestamps) > 0]
+        self.first = min(float(user_timestamps[0]) for user_timestamps in timestamps) if len(timestamps) > 0 else None
+        self.last = max(float(user_timestamps[-1]) for user_timestamps in timestamps) if len(timestamps) > 0 else None
+
+    def user_statistics(self, user: str, start: datetime, end: datetime) -> WindowStatistics:
+        start, end = start.timestamp(), end.timestamp()
+        user_events = self.events[user]
+        first, last = user_events.range(start, end)
+        count = last - first
+        interval = timedelta(seconds=float(user_events.timestamps[last - 1] - user_events.timestamps[first])) if count > 0 else timedelta()
+        if count > 1:
+            interval /= count - 1
+        leaders = self.leaders.get(user)
+        length = user_events.length_before(last)
+        return WindowStatistics(
+            user,
+            length,
+            length - user_events.length_before(first),
+            count,
+            interval,
+            timedelta(seconds=leaders.duration(start, end) if leaders is not None else 0.0),
+        )
+
+    # Users that had events, a length or the lead within the window
+    def statistics(self, start: datetime, end: datetime) -> dict[str, WindowStatistics]:
+        result = {}
+        for user in self.events.keys():
+            statistics = self.user_statistics(user, start, end)
+            if statistics.events_count > 0 or statistics.length != 0 or statistics.leader_duration > timedelta():
+                result[user] = statistics
+        return result
+
+    def domination_durations(self, start: datetime, end: datetime) -> dict[str, timedelta]:
+        start, end = start.timestamp(), end.timestamp()
+        durations = {user: timedelta(seconds=leaders.duration(start, end)) for user, leaders in self.leaders.items()}
+        return {user: duration for user, duration in durations.items() if duration > timedelta()}
+
+# Start of a calendar day in Kyiv time, where the chat lives
+def day_start(date: str) -> datetime:
+    return TIMEZONE.localize(datetime.fromisoformat(date[:10]))
+
+def day_end(date: str) -> datetime:
+    return TIMEZONE.localize(datetime.fromisoformat(date[:10]) + timedelta(days=1))